@@ -7,10 +7,10 @@ from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, current_user
 from flask_sock import Sock
 import redis
-from rq import Queue
 
 from lib import db
-from lib.conf import PRODUCTION
+from lib.conf import PASSWORD_ROUNDS, PRODUCTION, UPLOAD_DIR, USER_CACHE_SIZE, USER_CACHE_TTL
+import lib.queues as queues
 
 if PRODUCTION:
   SERVER_HOST = "http://simulator.pylabrobot.org/"
@@ -26,6 +26,7 @@ elif "SECRET_KEY_FILE" in os.environ:
     app.config["SECRET_KEY"] = f.read()
 else:
   raise Exception("No secret key specified")
+app.config["UPLOAD_DIR"] = UPLOAD_DIR
 
 dbs = db.get_session()
 
@@ -33,6 +34,7 @@ dbs = db.get_session()
 def shutdown_session(exception=None):
   dbs.remove()
 
+app.config["BCRYPT_LOG_ROUNDS"] = PASSWORD_ROUNDS # hashing is done by lib.passwords
 bcrypt = Bcrypt(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -55,13 +57,23 @@ redis_host = os.environ.get("REDIS_HOST", "localhost")
 redis_pool = redis.ConnectionPool(host=redis_host, port=6379, db=0, decode_responses=True)
 redis_client = redis.StrictRedis(connection_pool=redis_pool)
 
-q = Queue(connection=redis_client)
+q = queues.interactive(redis_client) # jobs the user is waiting for
+q_background = queues.background(redis_client)
 
 from lib.models import *
 
+from app.user_cache import CHANNEL as USERS_CHANNEL, UserCache, publish_invalidations
+users = UserCache(lambda user_id: User.query.get(user_id), max_size=USER_CACHE_SIZE,
+  ttl=USER_CACHE_TTL)
+publish_invalidations(redis_client)
+
+from app.fanout import Fanout
+fanout = Fanout(redis_client, patterns=("user-*", USERS_CHANNEL)).start()
+fanout.register(USERS_CHANNEL, users.invalidate)
+
 @login_manager.user_loader
 def load_user(user_id):
-  return User.query.get(user_id)
+  return users.get(user_id)
 
 @login_manager.unauthorized_handler
 def unauthorized():
@@ -78,6 +90,9 @@ loop = asyncio.new_event_loop()
 t = threading.Thread(target=start_background_loop, args=(loop,), daemon=True)
 t.start()
 
+from app.metrics import init_app as init_metrics
+init_metrics(app)
+
 from app.demo import demo
 app.register_blueprint(demo)
 
@@ -85,8 +100,12 @@ from app.auth import auth
 app.register_blueprint(auth)
 
 from app.platform import platform
+from app.platform.uploads import UploadRequest
+app.request_class = UploadRequest
 app.register_blueprint(platform)
 
 from lib.db import engine
 from lib.models.base import Base
 Base.metadata.create_all(engine)
+from lib.event_store import ensure_partitions
+ensure_partitions(engine)
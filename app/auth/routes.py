@@ -8,14 +8,23 @@ from flask import (
   jsonify,
   current_app
 )
-from flask_bcrypt import check_password_hash, generate_password_hash
 from flask_login import login_user, logout_user
 
-from app import q, dbs
+from app import q_background, dbs, redis_client
+from app.metrics import login_rejections
+from lib.conf import (
+  LOGIN_FAILURES_PER_IP,
+  LOGIN_FAILURES_PER_EMAIL,
+  LOGIN_THROTTLE_WINDOW,
+  PASSWORD_REHASH
+)
 from lib.models import User
 from lib import create_pod
+from lib.passwords import PoolBusy, get_pool
+import lib.pool as pool
 
 from .forms import SignUpForm
+from .throttle import Throttle, get_client_ip
 
 auth = Blueprint(
   "auth",
@@ -25,6 +34,9 @@ auth = Blueprint(
   static_folder="static"
 )
 
+ip_throttle = Throttle(redis_client, "login-ip", LOGIN_FAILURES_PER_IP, LOGIN_THROTTLE_WINDOW)
+email_throttle = Throttle(redis_client, "login-email", LOGIN_FAILURES_PER_EMAIL, LOGIN_THROTTLE_WINDOW)
+
 
 @auth.route("/login", methods=["GET", "POST"])
 def login():
@@ -37,22 +49,68 @@ def login():
       email = request.form.get("email")
       password = request.form.get("password")
 
-    user = User.query.filter_by(email=email).first()
-    if user is not None and check_password_hash(user.password_hash, password):
+    is_json = request.headers.get("Content-Type") == "application/json"
+    email_key = (email or "").strip().lower()
+    ip = get_client_ip()
+
+    # rejected before any password check, so a flood of attempts costs no bcrypt
+    reason = None
+    if ip_throttle.is_blocked(ip):
+      reason = "ip"
+    elif email_throttle.is_blocked(email_key):
+      reason = "email"
+    if reason is not None:
+      login_rejections.inc(reason=reason)
+      return _login_error("Too many login attempts, try again later", 429, is_json)
+
+    user = User.query.filter_by(email=email).first() if email and password else None
+    try:
+      valid = user is not None and get_pool().check(user.password_hash, password)
+    except PoolBusy:
+      login_rejections.inc(reason="busy")
+      return _login_error("The server is busy, try again in a moment", 503, is_json)
+
+    if valid:
+      email_throttle.reset(email_key)
+      if PASSWORD_REHASH and get_pool().needs_rehash(user.password_hash):
+        _rehash(user, password)
       login_user(user, remember=True)
-      if request.headers.get("Content-Type") == "application/json":
+      if is_json:
         return jsonify(user.serialize())
       else:
         return redirect(url_for("demo.index"))
 
-    if request.headers.get("Content-Type") == "application/json":
-      return jsonify({"error": "Invalid email or password"}), 401
-    else:
-      flash("Invalid email or password", "danger")
+    ip_throttle.hit(ip)
+    email_throttle.hit(email_key)
+    return _login_error("Invalid email or password", 401, is_json)
 
   return render_template("auth/login.html")
 
 
+def _login_error(message: str, status: int, is_json: bool):
+  if is_json:
+    response = jsonify({"error": message})
+  else:
+    flash(message, "danger")
+    response = current_app.make_response(render_template("auth/login.html"))
+  response.status_code = status
+  if status in (429, 503):
+    response.headers["Retry-After"] = str(LOGIN_THROTTLE_WINDOW if status == 429 else 5)
+  return response
+
+
+def _rehash(user, password: str):
+  """ Replace a hash with an outdated work factor, now that the password is known. """
+  try:
+    user.password_hash = get_pool().hash(password)
+    dbs.commit()
+  except PoolBusy:
+    pass # next time
+  except Exception as e:
+    dbs.rollback()
+    current_app.logger.error(e)
+
+
 @auth.route("/signup", methods=["GET", "POST"])
 def signup():
   form = SignUpForm()
@@ -65,7 +123,12 @@ def signup():
     email = form.email.data
     password = form.password.data
 
-    password_hash = generate_password_hash(password).decode("utf-8")
+    try:
+      password_hash = get_pool().hash(password)
+    except PoolBusy:
+      login_rejections.inc(reason="busy")
+      flash("The server is busy, try again in a moment", "danger")
+      return render_template("auth/signup.html", form=form), 503
     user = User(
       email=email,
       password_hash=password_hash,
@@ -86,8 +149,9 @@ def signup():
 
     login_user(user, remember=True)
 
-    # Create a container for this user in advance.
-    q.enqueue_call(create_pod, args=(str(user.id),))
+    # Create a container for this user in advance, unless they will get one from the pool.
+    if not pool.enabled():
+      q_background.enqueue_call(create_pod, args=(str(user.id),))
 
     return redirect(url_for("demo.index"))
   else:
@@ -0,0 +1,37 @@
+""" Login throttling, per IP address and per email, in redis.
+
+Counters are fixed windows: a key counts the hits since its first hit, and expires after `window`
+seconds. Blocked requests are rejected before the password is checked, so they cost a redis round
+trip and no bcrypt.
+"""
+
+from flask import request
+
+
+class Throttle:
+  def __init__(self, r, name: str, limit: int, window: int):
+    self.r = r
+    self.name = name
+    self.limit = limit
+    self.window = window
+
+  def _key(self, key: str) -> str:
+    return f"throttle.{self.name}.{key}"
+
+  def is_blocked(self, key: str) -> bool:
+    count = self.r.get(self._key(key))
+    return count is not None and int(count) >= self.limit
+
+  def hit(self, key: str):
+    with self.r.pipeline() as pipe:
+      pipe.set(self._key(key), 0, ex=self.window, nx=True) # starts the window
+      pipe.incr(self._key(key))
+      pipe.execute()
+
+  def reset(self, key: str):
+    self.r.delete(self._key(key))
+
+
+def get_client_ip() -> str:
+  # nginx-proxy sets X-Real-IP to the address of the client, overwriting what the client sent
+  return request.headers.get("X-Real-IP") or request.remote_addr or "unknown"
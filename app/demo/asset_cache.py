@@ -0,0 +1,155 @@
+""" Shared cache of static assets served by the notebook containers.
+
+All containers run the same `nb-simple` image, so the notebook's static files and the simulator's
+assets are the same for every user of that image. They are cached by image id and path, in memory
+and on disk, both with LRU eviction by size. Conditional requests are answered from the cache.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+from typing import List, NamedTuple, Optional, Tuple
+
+from lib.conf import ASSET_CACHE_DIR, ASSET_CACHE_DISK_BYTES, ASSET_CACHE_MEMORY_BYTES
+
+NOTEBOOK_PREFIXES = ("static/", "custom/")
+SIMULATOR_EXTENSIONS = (".js", ".css", ".png", ".jpg", ".svg", ".ico", ".woff", ".woff2", ".ttf",
+  ".map")
+
+
+class Asset(NamedTuple):
+  status: int
+  headers: List[Tuple[str, str]]
+  body: bytes
+  etag: str
+
+
+def is_cacheable(kind: str, method: str, path: str) -> bool:
+  if method != "GET":
+    return False
+  if kind == "notebook":
+    return path.startswith(NOTEBOOK_PREFIXES)
+  if kind == "simulator":
+    return path.endswith(SIMULATOR_EXTENSIONS)
+  return False
+
+def is_storable(status: int, headers) -> bool:
+  """ Only store plain successful responses that are not specific to the user. """
+  headers = {k.lower(): v for k, v in headers}
+  cache_control = headers.get("cache-control", "").lower()
+  return status == 200 and "set-cookie" not in headers and \
+    "no-store" not in cache_control and "private" not in cache_control
+
+def make_etag(body: bytes) -> str:
+  return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+class AssetCache:
+  def __init__(self, directory: str = ASSET_CACHE_DIR, memory_bytes: int = ASSET_CACHE_MEMORY_BYTES,
+    disk_bytes: int = ASSET_CACHE_DISK_BYTES):
+    self.directory = directory
+    self.memory_bytes = memory_bytes
+    self.disk_bytes = disk_bytes
+    self._memory = OrderedDict() # key -> Asset
+    self._memory_size = 0
+    self._disk = OrderedDict() # key -> size of body on disk
+    self._disk_size = 0
+    self._lock = threading.Lock()
+
+    os.makedirs(self.directory, exist_ok=True)
+    self._load_disk_index()
+
+  @staticmethod
+  def key(image_id: str, kind: str, path: str, query: str) -> str:
+    return hashlib.sha256(f"{image_id}\n{kind}\n{path}\n{query}".encode()).hexdigest()
+
+  def _paths(self, key: str):
+    base = os.path.join(self.directory, key)
+    return base + ".body", base + ".json"
+
+  def _load_disk_index(self):
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith(".body"):
+        stat = os.stat(os.path.join(self.directory, name))
+        entries.append((stat.st_atime, name[:-len(".body")], stat.st_size))
+    for _, key, size in sorted(entries): # least recently used first
+      self._disk[key] = size
+      self._disk_size += size
+
+  def get(self, key: str) -> Optional[Asset]:
+    with self._lock:
+      asset = self._memory.get(key)
+      if asset is not None:
+        self._memory.move_to_end(key)
+        return asset
+      on_disk = key in self._disk
+      if on_disk:
+        self._disk.move_to_end(key)
+
+    if not on_disk:
+      return None
+    body_path, meta_path = self._paths(key)
+    try:
+      with open(meta_path) as f:
+        meta = json.load(f)
+      with open(body_path, "rb") as f:
+        body = f.read()
+    except OSError:
+      with self._lock:
+        self._disk_size -= self._disk.pop(key, 0)
+      return None
+
+    asset = Asset(meta["status"], [tuple(h) for h in meta["headers"]], body, meta["etag"])
+    with self._lock:
+      self._put_memory(key, asset)
+    return asset
+
+  def put(self, key: str, asset: Asset):
+    with self._lock:
+      self._put_memory(key, asset)
+      if key in self._disk:
+        return
+    self._put_disk(key, asset)
+
+  def _put_memory(self, key: str, asset: Asset):
+    if len(asset.body) > self.memory_bytes:
+      return
+    if key in self._memory:
+      self._memory_size -= len(self._memory.pop(key).body)
+    self._memory[key] = asset
+    self._memory_size += len(asset.body)
+    while self._memory_size > self.memory_bytes:
+      _, evicted = self._memory.popitem(last=False)
+      self._memory_size -= len(evicted.body)
+
+  def _put_disk(self, key: str, asset: Asset):
+    if len(asset.body) > self.disk_bytes:
+      return
+    body_path, meta_path = self._paths(key)
+    tmp = f"{body_path}.{threading.get_ident()}.tmp"
+    try:
+      with open(tmp, "wb") as f:
+        f.write(asset.body)
+      with open(meta_path, "w") as f:
+        json.dump({"status": asset.status, "headers": asset.headers, "etag": asset.etag}, f)
+      os.replace(tmp, body_path)
+    except OSError as e:
+      print("error writing asset to disk cache", e)
+      return
+
+    evicted = []
+    with self._lock:
+      if key not in self._disk:
+        self._disk[key] = len(asset.body)
+        self._disk_size += len(asset.body)
+      while self._disk_size > self.disk_bytes:
+        evicted_key, size = self._disk.popitem(last=False)
+        self._disk_size -= size
+        evicted.append(evicted_key)
+    for evicted_key in evicted:
+      for path in self._paths(evicted_key):
+        try: os.remove(path)
+        except OSError: pass
@@ -0,0 +1,160 @@
+""" Bidirectional relay between a client websocket and an upstream websocket. """
+
+import asyncio
+import threading
+from typing import Callable, Optional
+
+from simple_websocket import ConnectionClosed
+import websockets
+
+from lib.conf import PRINT
+from lib import metrics
+
+CONNECT_TIMEOUT = 10 # seconds
+QUEUE_SIZE = 64 # frames buffered per direction
+
+_CLOSE = object() # sentinel
+
+relayed_bytes = metrics.counter("mirrored_bytes",
+  "Bytes relayed by websocket pumps, to the container (upstream) or to the client (downstream)",
+  labels=("direction",))
+relayed_frames = metrics.counter("mirrored_frames", "Frames relayed by websocket pumps",
+  labels=("direction",))
+
+
+class WebsocketPump:
+  """ Relay frames between a client websocket (simple_websocket, served on a request thread) and an
+  upstream websocket (websockets, on the shared asyncio loop).
+
+  Each direction has a bounded queue: when the client is slow, the pump stops reading from upstream,
+  and when upstream is slow, the request thread blocks before reading from the client. Either side
+  closing closes the other side.
+  """
+
+  active = set() # pumps that are currently relaying, for metrics
+  _active_lock = threading.Lock()
+  active_gauge = metrics.gauge("proxy_websockets", "Open websockets relayed to containers",
+    function=lambda: len(WebsocketPump.active))
+
+  def __init__(self, ws, url: str, loop: asyncio.AbstractEventLoop,
+    on_message: Optional[Callable] = None, queue_size: int = QUEUE_SIZE):
+    self.ws = ws
+    self.url = url
+    self.loop = loop
+    self.on_message = on_message
+    self.queue_size = queue_size
+
+    # counters, "in" is upstream -> client, "out" is client -> upstream
+    self.frames_in = 0
+    self.frames_out = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+    self._client = None
+    self._to_client: Optional[asyncio.Queue] = None
+    self._to_upstream: Optional[asyncio.Queue] = None
+    self._tasks = []
+
+  def _call(self, coro, timeout=None):
+    """ Run a coroutine on the loop and wait for its result. """
+    return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+  async def _connect(self):
+    self._client = await websockets.connect(self.url)
+    self._to_client = asyncio.Queue(self.queue_size)
+    self._to_upstream = asyncio.Queue(self.queue_size)
+    self._tasks = [
+      asyncio.ensure_future(self._read_upstream()),
+      asyncio.ensure_future(self._write_upstream()),
+    ]
+
+  async def _read_upstream(self):
+    try:
+      async for message in self._client:
+        await self._to_client.put(message) # blocks while the client is behind
+    except websockets.ConnectionClosed:
+      pass
+    await self._to_client.put(_CLOSE)
+
+  async def _write_upstream(self):
+    while True:
+      message = await self._to_upstream.get()
+      if message is _CLOSE:
+        break
+      try:
+        await self._client.send(message)
+      except websockets.ConnectionClosed:
+        pass # keep draining, the reader will see the close and close the client
+
+  async def _close(self):
+    for task in self._tasks:
+      task.cancel()
+    if self._client is not None:
+      await self._client.close()
+    if self._to_client is not None:
+      # Drop frames the client will never read, and wake up the sender.
+      while not self._to_client.empty():
+        self._to_client.get_nowait()
+      self._to_client.put_nowait(_CLOSE)
+
+  def _send_to_client(self):
+    """ Drain frames from upstream to the client, on its own thread. """
+    while True:
+      message = self._call(self._to_client.get())
+      if message is _CLOSE:
+        break
+      try:
+        self.ws.send(message)
+      except ConnectionClosed:
+        break
+      self.frames_in += 1
+      self.bytes_in += len(message)
+      relayed_frames.inc(direction="downstream")
+      relayed_bytes.inc(len(message), direction="downstream")
+      if self.on_message is not None:
+        self.on_message(message, self.ws)
+
+    # Upstream closed, close the client too, which ends the receive loop in `run`.
+    try: self.ws.close()
+    except: pass
+
+  def run(self):
+    """ Connect upstream and relay until either side closes. Blocks the calling (request) thread. """
+    if PRINT: print("#"*10, "connecting ws to", self.url)
+    connect = asyncio.run_coroutine_threadsafe(self._connect(), self.loop)
+    try:
+      connect.result(CONNECT_TIMEOUT)
+    except Exception as e:
+      connect.cancel()
+      print("error connecting ws to", self.url, e)
+      try: self.ws.close()
+      except: pass
+      return
+
+    with WebsocketPump._active_lock:
+      WebsocketPump.active.add(self)
+    sender = threading.Thread(target=self._send_to_client, daemon=True)
+    sender.start()
+
+    try:
+      while True:
+        try:
+          message = self.ws.receive()
+        except ConnectionClosed:
+          if PRINT: print("#"*10, "connection closed")
+          break
+        if message is None:
+          continue
+        self._call(self._to_upstream.put(message)) # blocks while upstream is behind
+        self.frames_out += 1
+        self.bytes_out += len(message)
+        relayed_frames.inc(direction="upstream")
+        relayed_bytes.inc(len(message), direction="upstream")
+    finally:
+      self._call(self._close())
+      sender.join()
+      with WebsocketPump._active_lock:
+        WebsocketPump.active.discard(self)
+      if PRINT:
+        print("#"*10, "closed ws to", self.url, f"in: {self.frames_in} frames {self.bytes_in} bytes,",
+          f"out: {self.frames_out} frames {self.bytes_out} bytes")
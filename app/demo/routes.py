@@ -1,10 +1,8 @@
-import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
 import functools
 import re
 import requests
-import time
-import threading
 import urllib
 
 from flask import request, jsonify, session, url_for, redirect, Response, Blueprint, render_template
@@ -15,19 +13,20 @@ from lib.events import (
   NOTEBOOK_STOPPED,
   SIMULATION_FILE_SERVER_STARTED,
   SIMULATION_FILE_SERVER_STOPPED,
+  QUEUED,
 )
 from simple_websocket import ConnectionClosed
-import redis
-import websockets
+from werkzeug.http import unquote_etag
 
 from app import (
   get_session_id,
   sock,
   loop,
   redis_client,
-  redis_pool,
+  fanout,
   SERVER_HOST,
   q,
+  q_background,
   dbs,
 )
 import lib as lib
@@ -40,10 +39,21 @@ from lib import (
   update_container
 )
 import lib.cache as cache
+import lib.event_store as event_store
+from lib.models import Event
+import lib.pool as pool
+import lib.scheduler as scheduler
+
+from app.fanout import Outbox
+from app.metrics import asset_cache_requests, count_forwarded, forwarded_bytes, master_websockets
+from app.platform.pagination import InvalidCursor, paginate, parse_limit
+from .asset_cache import Asset, AssetCache, is_cacheable, is_storable, make_etag
+from .pump import WebsocketPump
 
 def session_del(key): cache.del_(redis_client, key, current_user.id)
 def session_has(key): return cache.has(redis_client, key, current_user.id)
 def session_get(key): return cache.get(redis_client, key, current_user.id)
+def session_get_all(): return cache.get_all(redis_client, current_user.id)
 def session_set(key, value): cache.set(redis_client, key, value, current_user.id)
 def session_clear(): cache.clear(redis_client, current_user.id)
 
@@ -124,24 +134,51 @@ def get_session():
   # This is to save time on the request.
 
   sid = get_session_id()
-  err = create_pod(sid) # Create_pod checks if pod exists, and if not, creates it.
-  if err is not None:
-    return {"error": err, "type": "error"}
+  if not pool.claim(redis_client, sid, q_background): # New users get a pre-started container if available.
+    err = create_pod(sid) # Create_pod checks if pod exists, and if not, creates it.
+    if err is not None:
+      return {"error": err, "type": "error"}
 
   print("*"*10, "get_session", sid)
-  if not session_get(cache.keys.container_running) == "1":
-    q.enqueue_call(run_pod, args=(sid,))
+  state = session_get_all()
+  d = {"session_id": sid}
+  if not state.get(cache.keys.container_running) == "1":
+    # Start the container if there is room on the host, otherwise wait in the queue.
+    position = scheduler.request_start(redis_client, sid)
+    if position == 0:
+      q.enqueue_call(run_pod, args=(sid,))
+    else:
+      d["queue_position"] = position
   else:
     print("is running?", sid)
 
-  d = {"session_id": sid}
-  if session_get(cache.keys.notebook_running) == "1":
+  if state.get(cache.keys.notebook_running) == "1":
     iframe_url = "/notebook/notebooks/notebook.ipynb"
     d["notebook_iframe_url"] = iframe_url
-  if session_get(cache.keys.simulator_running) == "1":
+  if state.get(cache.keys.simulator_running) == "1":
     d["simulator_url"] = url_for("demo.simulator_index")
   return d
 
+@demo.route("/events")
+@login_required
+def event_timeline():
+  """ The user's event timeline, newest first, paginated with `cursor` and `limit`. """
+  try:
+    events, next_cursor = paginate(event_store.timeline(dbs, current_user.id), Event,
+      request.args.get("cursor"), parse_limit(request.args.get("limit")))
+  except InvalidCursor as e:
+    return jsonify({"error": str(e)}), 400
+  return jsonify({
+    "events": [{**event.serialize(), "code": event.code} for event in events],
+    "next_cursor": next_cursor,
+  })
+
+
+@demo.route("/pool")
+@login_required
+def pool_stats():
+  return jsonify(pool.stats(redis_client))
+
 master_websocket_servers = {}
 
 @sock.route("/master")
@@ -150,25 +187,52 @@ def master(ws):
   """ Handle a websocket connection to the master server. """
   sid = None
 
-  # Get new redis connection, because pubsub blocks the connection.
-  r = redis.StrictRedis(connection_pool=redis_pool)
-  p = r.pubsub()
+  # Events for this user are dispatched by the process-wide pubsub subscriber. They are handled on
+  # its thread, so resolve urls now, while we have a request context. Everything sent to the client,
+  # events and replies, goes through the outbox, which sends on a thread of its own.
   channel = get_pubsub_channel_name(current_user.id)
-  p.subscribe(channel)
+  simulator_url = url_for("demo.simulator_index", path="/")
+  outbox = Outbox(ws).start()
+
+  def on_event(data):
+    if PRINT: print("!" * 10, "got pubsub message", data)
+    data = json.loads(data)
+    event = data.get("event")
+
+    if event == NOTEBOOK_STARTED:
+      iframe_url = "/notebook/notebooks/notebook.ipynb"
+      outbox.send(json.dumps({"type": "start-notebook", "url": iframe_url}))
+    elif event == CONTAINER_STARTED:
+      update_available = data.get("update_available", False)
+      outbox.send(json.dumps({
+        "type": "start-container",
+        "update_available": update_available}))
+    elif event == NOTEBOOK_STOPPED:
+      outbox.send(json.dumps({"type": "stop-notebook"}))
+    elif event == SIMULATION_FILE_SERVER_STARTED:
+      outbox.send(json.dumps({
+        "type": "start-simulator",
+        "url": simulator_url}))
+    elif event == SIMULATION_FILE_SERVER_STOPPED:
+      outbox.send(json.dumps({"type": "stop-simulator"}))
+    elif event == QUEUED:
+      outbox.send(json.dumps({"type": "queue-position", "position": data.get("position")}))
+
+  fanout.register(channel, on_event)
+  scheduler.connect(redis_client, current_user.id)
+  master_websockets.inc()
 
-  while True:
-    # read using timeout=0 for non-blocking, ...
-    try:
-      message = ws.receive(timeout=0)
-    except ConnectionClosed:
-      break
+  try:
+    while True:
+      try:
+        message = ws.receive() # blocks until a message is available
+      except ConnectionClosed:
+        break
 
-    # ..., which returns None if no message is available.
-    if message is not None:
       # Try to decode the message as JSON.
       try: message = json.loads(message)
       except json.JSONDecodeError:
-        ws.send("Invalid JSON")
+        outbox.send("Invalid JSON")
         print("Invalid JSON")
         continue
 
@@ -180,46 +244,18 @@ def master(ws):
         master_websocket_servers[sid] = ws
         print("set master", sid)
         d.update(get_session())
-        ws.send(json.dumps(d))
+        outbox.send(json.dumps(d))
       elif message.get("event") == "ping":
-        ws.send(json.dumps({ "event": "pong" }))
+        outbox.send(json.dumps({ "event": "pong" }))
       elif message.get("event") == "update":
         q.enqueue_call(update_container, args=(sid,))
-
-    # Listen for messages on the pubsub channel.
-    message = p.get_message() # also non-blocking
-    if message is not None:
-      if PRINT: print("!" * 10, "got pubsub message", message)
-
-      if message.get("type") == "message":
-        data = message.get("data")
-        data = json.loads(data)
-        event = data.get("event")
-
-        if event == NOTEBOOK_STARTED:
-          iframe_url = "/notebook/notebooks/notebook.ipynb"
-          ws.send(json.dumps({"type": "start-notebook", "url": iframe_url}))
-        elif event == CONTAINER_STARTED:
-          update_available = data.get("update_available", False)
-          ws.send(json.dumps({
-            "type": "start-container",
-            "update_available": update_available}))
-        elif event == NOTEBOOK_STOPPED:
-          ws.send(json.dumps({"type": "stop-notebook"}))
-        elif event == SIMULATION_FILE_SERVER_STARTED:
-          ws.send(json.dumps({
-            "type": "start-simulator",
-            "url": url_for("demo.simulator_index", path="/")}))
-        elif event == SIMULATION_FILE_SERVER_STOPPED:
-          ws.send(json.dumps({"type": "stop-simulator"}))
-
-    time.sleep(0.0001)
-
-  try: ws.close()
-  except: pass
-
-  try: p.close()
-  except: pass
+  finally:
+    master_websockets.dec()
+    fanout.unregister(channel, on_event)
+    scheduler.disconnect(redis_client, current_user.id)
+    if master_websocket_servers.get(sid) is ws:
+      master_websocket_servers.pop(sid)
+    outbox.close()
 
 ss = {}
 
@@ -232,10 +268,70 @@ def get_requests_session():
 
 all_methods = ["GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH", "CONNECT"]
 
-def forward(url):
-  """ Forward a request to {notebook, kernel gateway} server. """
+STREAM_CHUNK_SIZE = 64 * 1024
+UPSTREAM_TIMEOUT = (5, 90) # (connect, read) seconds
+
+# hop-by-hop headers, and headers that requests sets itself for the streamed body
+_streaming_excluded_request_headers = ["host", "content-length", "transfer-encoding", "connection"]
+_streaming_excluded_response_headers = ["transfer-encoding", "connection", "keep-alive"]
+
+class _RequestBody:
+  """ The incoming request body as a file-like object with a known length, so that requests streams
+  it upstream with a Content-Length instead of reading it into memory. """
+
+  def __init__(self, stream, length):
+    self.stream = stream
+    self.length = length
+
+  def read(self, size=STREAM_CHUNK_SIZE):
+    return self.stream.read(min(size, STREAM_CHUNK_SIZE) if size >= 0 else STREAM_CHUNK_SIZE)
+
+  def __len__(self):
+    return self.length
+
+  def __iter__(self):
+    return iter(lambda: self.read(STREAM_CHUNK_SIZE), b"")
+
+def _get_streaming_request_body():
+  if request.content_length is not None:
+    if request.content_length == 0:
+      return None
+    return _RequestBody(request.stream, request.content_length)
+  if request.headers.get("Transfer-Encoding", "").lower() == "chunked":
+    return iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b"")
+  return None
+
+def forward(url, stream=False):
+  """ Forward a request to {notebook, kernel gateway} server.
+
+  With `stream`, request and response bodies are relayed chunk by chunk instead of being read into
+  memory, and content encoding is passed through as is.
+  """
   s = get_requests_session()
   requests.utils.add_dict_to_cookiejar(s.cookies, request.cookies) # needed? probably?
+
+  if stream:
+    resp = s.request(
+          method=request.method,
+          url=url,
+          headers={key: value for (key, value) in request.headers
+                   if key.lower() not in _streaming_excluded_request_headers},
+          data=_get_streaming_request_body(),
+          cookies=request.cookies,
+          allow_redirects=False,
+          stream=True,
+          timeout=UPSTREAM_TIMEOUT)
+
+    headers = [(k, v) for k, v in resp.headers.items()
+               if k.lower() not in _streaming_excluded_response_headers]
+    if request.content_length:
+      forwarded_bytes.inc(request.content_length, direction="upstream")
+    body = count_forwarded(resp.raw.stream(STREAM_CHUNK_SIZE, decode_content=False))
+    response = Response(body, resp.status_code, headers, direct_passthrough=True)
+    response.call_on_close(resp.close)
+    if PRINT: print("*"*10, "streaming", request.url, "->", url, f"({resp.status_code})")
+    return response
+
   headers = {key: value for key, value in request.headers}# if key != 'Host'}
   headers["X-Forwarded-Proto"] = "http"
   resp = s.request(
@@ -246,6 +342,9 @@ def forward(url):
         cookies=request.cookies,
         allow_redirects=False)
 
+  forwarded_bytes.inc(len(request.get_data()), direction="upstream")
+  forwarded_bytes.inc(len(resp.content), direction="downstream")
+
   # filter out headers that are not allowed to be sent to the client
   excluded_headers = ["content-encoding", "content-length", "transfer-encoding", "connection"]
   headers = [(k, v) for k, v in resp.headers.items() if k not in excluded_headers]
@@ -253,6 +352,42 @@ def forward(url):
   if PRINT: print("*"*10, "forwarding", request.url, "->", url, f"({resp.status_code})", resp.content[:20])
   return response
 
+asset_cache = AssetCache()
+
+def forward_asset(url, kind, path):
+  """ Forward a request for a static asset of the container image, answering from the shared asset
+  cache when possible. """
+  image = lib.get_container_image(redis_client, current_user.id)
+  if image is None:
+    return forward(url, stream=True)
+
+  key = AssetCache.key(image, kind, path, request.query_string.decode())
+  asset = asset_cache.get(key)
+  asset_cache_requests.inc(result="miss" if asset is None else "hit")
+  if asset is None:
+    s = get_requests_session()
+    # Never forward conditional headers, the cache needs the body.
+    resp = s.get(url,
+      headers={k: v for (k, v) in request.headers
+               if k.lower() not in ["host", "if-none-match", "if-modified-since"]},
+      cookies=request.cookies,
+      allow_redirects=False,
+      timeout=UPSTREAM_TIMEOUT)
+    excluded_headers = ["content-encoding", "content-length", "transfer-encoding", "connection",
+      "date", "etag"]
+    headers = [(k, v) for k, v in resp.headers.items() if k.lower() not in excluded_headers]
+    if not is_storable(resp.status_code, resp.headers.items()):
+      return Response(resp.content, resp.status_code, headers)
+    asset = Asset(resp.status_code, headers, resp.content,
+      resp.headers.get("ETag") or make_etag(resp.content))
+    asset_cache.put(key, asset)
+    if PRINT: print("*"*10, "cached asset", request.url, "->", url)
+
+  if request.if_none_match.contains_weak(unquote_etag(asset.etag)[0]):
+    cache_headers = [(k, v) for k, v in asset.headers if k.lower() in ["cache-control", "expires"]]
+    return Response(status=304, headers=cache_headers + [("ETag", asset.etag)])
+  return Response(asset.body, asset.status, asset.headers + [("ETag", asset.etag)])
+
 def get_host_for_user(uid):
   return f"nb-{uid}"
 
@@ -268,68 +403,47 @@ def notebook(path):
   if path.endswith("/restart") or \
     (path.startswith("api/sessions/") and request.method == "DELETE"):
     # On notebook restart/shutdown, the simulation server is stopped.
-    lib.handle_simulator_stopped(redis_client, dbs, current_user.id)
-
-  return forward(request_url)
+    lib.handle_simulator_stopped(redis_client, current_user.id)
 
-websocket_clients = {}
+  if is_cacheable("notebook", request.method, path):
+    return forward_asset(request_url, "notebook", path)
+  return forward(request_url, stream=True)
 
 def mirror(ws, url, on_message=None):
-  async def send_websocket_message(message, client):
-    await client.send(message)
-
-  if PRINT: print("#"*10, "connecting ws to", url)
-
-  # TODO: replace lock with client callback.
-  async def start_websocket_client(url, lock, ws):
-    print("@"*10, "connecting ws to", url)
-    async with websockets.connect(url) as client:
-      websocket_clients[get_session_id()] = client
-      lock.release()
-      print("@"*10, "connected ws to", url)
-
-      while True:
-        message = await client.recv()
-        if PRINT: print("<"*10, message)
-        ws.send(message)
-        if on_message is not None:
-          on_message(message, ws)
-
-  client_started_lock = threading.Lock()
-  client_started_lock.acquire()
-  asyncio.run_coroutine_threadsafe(start_websocket_client(url, client_started_lock, ws), loop)
-  while client_started_lock.locked():
-    time.sleep(0.1)
-
-  client = websocket_clients.get(get_session_id())
-  while True:
-    try:
-      message = ws.receive()
-      if PRINT: print(">"*10, message)
-      asyncio.run_coroutine_threadsafe(send_websocket_message(message, client), loop)
-    except ConnectionClosed:
-      if PRINT: print("#"*10, "connection closed")
-      break
-
-  # close client too
-  asyncio.run_coroutine_threadsafe(websocket_clients.get(get_session_id()).close(), loop)
-  websocket_clients.pop(get_session_id())
-
-
-def on_message(message, ws): # scan notebook output for simulation started command.
+  """ Relay a websocket connection to the container, see `WebsocketPump`. """
+  WebsocketPump(ws, url, loop, on_message=on_message).run()
+
+
+# Simulator start/stop handling talks to redis, keep it off the relay thread. A single worker keeps
+# the events of a user in the order of the kernel output (a stop followed by a start must not finish
+# as start, stop). The handlers are a few redis calls, one thread keeps up.
+simulator_event_executor = ThreadPoolExecutor(max_workers=1)
+
+def _handle_simulator_event(handler, uid):
+  handler(redis_client, uid)
+
+def on_message(message, ws, uid): # scan notebook output for simulation started command.
+  # Fast path: most frames (status, comms, display data, images) can't contain the markers. Check the
+  # raw frame before parsing it.
+  if not isinstance(message, str):
+    return
+  if "File server started at" not in message and "server closed" not in message:
+    return
+  if '"msg_type": "execute_result"' not in message and '"msg_type": "stream"' not in message:
+    return
+
   try:
     data = json.loads(message)
   except:
     print("error parsing message", message)
     data = None
 
+  output = None
   try:
     if data.get("msg_type") == "execute_result":
       output = data["content"]["data"].get("text/plain")
     elif data.get("msg_type") == "stream":
       output = data["content"]["text"]
-    else:
-      output = None
   except (AttributeError, KeyError):
     pass
 
@@ -340,14 +454,14 @@ def on_message(message, ws): # scan notebook output for simulation started comma
     if matches is not None:
       # Send data to pubsub. This data will get picked up by a sub if a websocket is connected to
       # the pubsub channel.
-      lib.handle_simulator_started(redis_client, dbs, current_user.id)
+      simulator_event_executor.submit(_handle_simulator_event, lib.handle_simulator_started, uid)
     elif "File server started at " in output:
       # Debug message for regex, not really needed
       print("No match for file server while output was:", output)
 
     # Store file server URL in the session
     if "server closed" in output:
-      lib.handle_simulator_stopped(redis_client, dbs, current_user.id)
+      simulator_event_executor.submit(_handle_simulator_event, lib.handle_simulator_stopped, uid)
 
 
 @sock.route("/notebook/<path:path>")
@@ -358,7 +472,7 @@ def notebook_ws(ws, path):
   url = request.url.replace(SERVER_HOST, nb_url)
   url = url.replace("http", "ws")
 
-  return mirror(ws, url, on_message)
+  return mirror(ws, url, functools.partial(on_message, uid=current_user.id))
 
 @demo.route("/simulator", defaults={"path": "/"})
 @demo.route("/simulator/<path:path>")
@@ -366,7 +480,9 @@ def notebook_ws(ws, path):
 def simulator_index(path):
   file_server_url = _get_fs_url_for_user(current_user.id)
   request_url = request.url.replace(request.host_url, file_server_url).replace("/simulator", "")
-  return forward(request_url)
+  if is_cacheable("simulator", request.method, path):
+    return forward_asset(request_url, "simulator", path)
+  return forward(request_url, stream=True)
 
 @sock.route("/simulator-ws")
 @demo_required_ws
@@ -0,0 +1,122 @@
+""" Fan out redis pubsub messages to handlers in this process.
+
+A single pubsub connection per process is pattern-subscribed to the user channels, and each message is
+dispatched to the handlers registered for its channel, e.g. the `/master` websockets of that user.
+Handlers run on the fanout thread, so they must not block: websockets get their messages through an
+`Outbox`, which sends from a thread (a greenlet under gevent) of its own.
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Dict, Set
+
+import redis
+
+Handler = Callable[[str], None]
+
+OUTBOX_SIZE = 64 # messages waiting to be sent to one websocket
+
+_CLOSE = object() # sentinel
+
+
+class Fanout:
+  def __init__(self, redis_client: redis.StrictRedis, patterns=("user-*",)):
+    self.redis_client = redis_client
+    self.patterns = patterns
+    self._handlers: Dict[str, Set[Handler]] = {}
+    self._lock = threading.Lock()
+
+  def register(self, channel: str, handler: Handler):
+    with self._lock:
+      self._handlers.setdefault(channel, set()).add(handler)
+
+  def unregister(self, channel: str, handler: Handler):
+    with self._lock:
+      handlers = self._handlers.get(channel)
+      if handlers is None:
+        return
+      handlers.discard(handler)
+      if len(handlers) == 0:
+        del self._handlers[channel]
+
+  def num_handlers(self) -> int:
+    with self._lock:
+      return sum(len(handlers) for handlers in self._handlers.values())
+
+  def start(self):
+    threading.Thread(target=self._run, daemon=True).start()
+    return self
+
+  def _run(self):
+    while True:
+      p = self.redis_client.pubsub(ignore_subscribe_messages=True)
+      try:
+        p.psubscribe(*self.patterns)
+        for message in p.listen(): # blocks until a message arrives
+          self._dispatch(message)
+      except redis.ConnectionError as e:
+        print("fanout: lost redis connection, reconnecting", e)
+        time.sleep(1)
+      finally:
+        try: p.close()
+        except: pass
+
+  def _dispatch(self, message):
+    if message.get("type") not in ("message", "pmessage"):
+      return
+    channel = message.get("channel")
+    with self._lock:
+      handlers = list(self._handlers.get(channel, ()))
+    for handler in handlers:
+      try:
+        handler(message.get("data"))
+      except Exception as e:
+        print("fanout: error in handler for", channel, e)
+
+
+class Outbox:
+  """ Messages to one websocket, sent in order by a sender thread. All sends to the websocket should
+  go through the outbox, so that it has a single writer. When the client does not keep up and the
+  outbox is full, the websocket is closed, and the client reconnects and gets the current state. """
+
+  def __init__(self, ws, size: int = OUTBOX_SIZE):
+    self.ws = ws
+    self.closed = False
+    self._queue = queue.Queue(size)
+
+  def start(self):
+    threading.Thread(target=self._run, daemon=True).start()
+    return self
+
+  def send(self, message: str):
+    if self.closed:
+      return
+    try:
+      self._queue.put_nowait(message)
+    except queue.Full:
+      print("fanout: websocket outbox is full, closing the websocket")
+      self.close()
+
+  def close(self):
+    """ Stop the sender after the message it is sending, and close the websocket. """
+    self.closed = True
+    while True:
+      try:
+        self._queue.put_nowait(_CLOSE)
+        return
+      except queue.Full:
+        try: self._queue.get_nowait() # pending messages are dropped, the sender is done anyway
+        except queue.Empty: pass
+
+  def _run(self):
+    while True:
+      message = self._queue.get()
+      if message is _CLOSE:
+        break
+      try:
+        self.ws.send(message)
+      except Exception: # closed by the client
+        break
+    try: self.ws.close()
+    except: pass
@@ -0,0 +1,55 @@
+""" Metrics of the web server, see lib/metrics.py.
+
+They are served on the internal `METRICS_PORT` listener, like the worker's and the monitor's, and not
+by the app: the app is public behind nginx-proxy, and the metrics include request paths and counts.
+"""
+
+import time
+
+from flask import g, request
+
+from lib import metrics
+from lib.conf import METRICS_PORT
+from lib.passwords import get_pool as get_password_pool
+
+request_duration = metrics.histogram("http_request_duration_seconds",
+  "Time until the response headers are ready, per route", labels=("endpoint", "method", "status"))
+master_websockets = metrics.gauge("master_websockets", "Open /master websockets")
+forwarded_bytes = metrics.counter("forwarded_bytes",
+  "Bytes relayed by forward(), to the container (upstream) or to the client (downstream)",
+  labels=("direction",))
+# websockets relayed by mirror() are counted in app/demo/pump.py
+asset_cache_requests = metrics.counter("asset_cache_requests", "Requests for cacheable assets",
+  labels=("result",))
+
+login_rejections = metrics.counter("login_rejections",
+  "Logins and signups rejected before checking the password", labels=("reason",))
+password_hashes_pending = metrics.gauge("password_hashes_pending",
+  "Password hashes queued or running in the pool", function=lambda: get_password_pool().pending)
+
+def count_forwarded(chunks):
+  """ Count the bytes of a streamed body as they go to the client. """
+  for chunk in chunks:
+    forwarded_bytes.inc(len(chunk), direction="downstream")
+    yield chunk
+
+
+def init_app(app):
+  def before():
+    g.request_start = time.perf_counter()
+
+  def after(response):
+    start = g.pop("request_start", None)
+    # websockets (flask-sock) return when the socket closes, their duration is not a latency
+    if start is not None and request.headers.get("Upgrade", "").lower() != "websocket":
+      request_duration.observe(time.perf_counter() - start, endpoint=request.endpoint or "none",
+        method=request.method, status=response.status_code)
+    return response
+
+  app.before_request(before)
+  app.after_request(after)
+
+  try:
+    metrics.serve(METRICS_PORT)
+  except OSError as e: # e.g. the parent process of the dev server's reloader holds the port
+    print("not serving metrics:", e)
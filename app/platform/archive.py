@@ -0,0 +1,136 @@
+""" Zip archives of projects, streamed as they are written or read.
+
+An export is a zip with `project.json` (the project's name and its files) and the files under
+`files/`. The zip is written to a buffer that is emptied after every chunk, so a response never holds
+more than a chunk of it, and no temporary file is needed. Zip files can't be read as a stream (the
+directory is at the end), so imports read the uploaded archive from werkzeug's temporary file, and
+copy each member into a blob writer chunk by chunk. The members are only committed to the blob store
+once all of them were read, so a corrupt archive leaves nothing behind.
+"""
+
+import io
+import json
+import time
+from typing import Iterable, Iterator, Tuple
+import zipfile
+import zlib
+
+from lib.blob_store import CHUNK_SIZE, BlobStore
+
+MANIFEST = "project.json"
+FILES_DIR = "files/"
+
+MAX_IMPORT_FILES = 10000
+MAX_IMPORT_BYTES = 1024 * 1024 * 1024 # uncompressed
+
+
+class InvalidArchive(ValueError):
+  pass
+
+
+class _StreamBuffer(io.RawIOBase):
+  """ Unseekable sink for `zipfile`, which then writes data descriptors instead of seeking back. """
+
+  def __init__(self):
+    self._chunks = []
+
+  def writable(self):
+    return True
+
+  def write(self, b):
+    self._chunks.append(bytes(b))
+    return len(b)
+
+  def drain(self) -> bytes:
+    data = b"".join(self._chunks)
+    self._chunks = []
+    return data
+
+
+def unique_names(names: Iterable[str]) -> Iterator[str]:
+  """ Archive names for files, "name (2).ext" for the second file with the same name. """
+  seen = {}
+  for name in names:
+    count = seen.get(name, 0) + 1
+    seen[name] = count
+    if count == 1:
+      yield name
+    else:
+      base, dot, extension = name.rpartition(".")
+      yield f"{base} ({count}).{extension}" if dot else f"{name} ({count})"
+
+
+def stream_zip(project_name: str, files: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+  """ Zip of a project, `files` are (name, path) pairs. """
+  files = list(files)
+  names = list(unique_names(name for name, _ in files))
+  buffer = _StreamBuffer()
+  date_time = time.localtime()[:6]
+
+  with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+    manifest = {"name": project_name, "files": names}
+    zf.writestr(zipfile.ZipInfo(MANIFEST, date_time), json.dumps(manifest, indent=2))
+    yield buffer.drain()
+
+    for name, (_, path) in zip(names, files):
+      info = zipfile.ZipInfo(FILES_DIR + name, date_time)
+      info.compress_type = zipfile.ZIP_DEFLATED
+      with open(path, "rb") as src, zf.open(info, mode="w", force_zip64=True) as dest:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+          dest.write(chunk)
+          yield buffer.drain()
+      yield buffer.drain()
+  yield buffer.drain() # central directory
+
+
+def read_zip(fileobj, blob_store: BlobStore, allowed) -> Tuple[str, list]:
+  """ Store the files of an exported project. Returns the project name and (name, hash, size) of each
+  file. `allowed` tells if a file name can be imported. """
+  try:
+    zf = zipfile.ZipFile(fileobj)
+  except zipfile.BadZipFile as e:
+    raise InvalidArchive("Not a zip file") from e
+
+  with zf:
+    infos = [info for info in zf.infolist()
+             if info.filename.startswith(FILES_DIR) and not info.is_dir()]
+    if len(infos) > MAX_IMPORT_FILES:
+      raise InvalidArchive("Too many files")
+    if sum(info.file_size for info in infos) > MAX_IMPORT_BYTES:
+      raise InvalidArchive("Archive too large")
+
+    name = None
+    if MANIFEST in zf.namelist():
+      try:
+        manifest = json.loads(zf.read(MANIFEST))
+      except (ValueError, zipfile.BadZipFile, zlib.error, EOFError) as e:
+        raise InvalidArchive("Malformed project.json") from e
+      if not isinstance(manifest, dict):
+        raise InvalidArchive("Malformed project.json")
+      name = manifest.get("name")
+      if name is not None and not isinstance(name, str):
+        raise InvalidArchive("Malformed project.json: name must be a string")
+
+    writers = [] # (file name, writer)
+    try:
+      for info in infos:
+        file_name = info.filename[len(FILES_DIR):].rsplit("/", 1)[-1]
+        if not allowed(file_name):
+          raise InvalidArchive("Invalid file type for file: " + file_name)
+        writer = blob_store.writer()
+        writers.append((file_name, writer))
+        try:
+          with zf.open(info) as src: # reads at most `file_size` bytes, checks the CRC at the end
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+              writer.write(chunk)
+        except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError) as e:
+          raise InvalidArchive("Corrupt file in archive: " + file_name) from e
+
+      stored = []
+      for file_name, writer in writers:
+        digest, size = blob_store.commit(writer)
+        stored.append((file_name, digest, size))
+    finally:
+      for _, writer in writers:
+        writer.close() # removes the temporary files of writers that were not committed
+  return name, stored
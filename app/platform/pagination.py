@@ -0,0 +1,48 @@
+""" Keyset pagination on (`created_on`, `id`), newest first.
+
+The cursor is the sort key of the last row of a page, so a page is one index range scan no matter how
+deep it is, and rows that are added while paging don't shift the pages.
+"""
+
+import base64
+import datetime
+from typing import List, Optional, Tuple
+import uuid
+
+from sqlalchemy import tuple_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class InvalidCursor(ValueError):
+  pass
+
+
+def encode_cursor(row) -> str:
+  key = f"{row.created_on.isoformat()}|{row.id}"
+  return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, uuid.UUID]:
+  try:
+    created_on, id_ = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.datetime.fromisoformat(created_on), uuid.UUID(id_)
+  except ValueError as e:
+    raise InvalidCursor("Malformed cursor") from e
+
+def parse_limit(limit: Optional[str]) -> int:
+  if limit is None:
+    return DEFAULT_LIMIT
+  try:
+    return max(1, min(int(limit), MAX_LIMIT))
+  except ValueError as e:
+    raise InvalidCursor("Malformed limit") from e
+
+def paginate(query, model, cursor: Optional[str], limit: int) -> Tuple[List, Optional[str]]:
+  """ Get a page of `query`, returns the rows and the cursor of the next page (None if last). """
+  if cursor is not None:
+    query = query.filter(tuple_(model.created_on, model.id) < decode_cursor(cursor))
+  rows = query.order_by(model.created_on.desc(), model.id.desc()).limit(limit + 1).all()
+  if len(rows) > limit:
+    return rows[:limit], encode_cursor(rows[limit - 1])
+  return rows, None
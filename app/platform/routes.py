@@ -1,14 +1,25 @@
+import mimetypes
 import os
+import urllib.parse
+import uuid
 
 import sqlalchemy
 
-from flask import render_template, request,jsonify, Blueprint, current_app, send_file, flash
+from flask import render_template, request,jsonify, Blueprint, current_app, send_file, flash, Response
 from flask_login import current_user, login_required
 import sqlalchemy
+from sqlalchemy.orm import selectinload
 from werkzeug.utils import secure_filename
 
-from app import dbs
-from lib.models import File, Project
+from app import dbs, q_background
+from lib.conf import DOWNLOAD_ACCEL_PREFIX
+import lib.deck_files as deck_files
+import lib.project_sync as project_sync
+from lib.models import File, FileSummary, Project
+
+from .archive import InvalidArchive, read_zip, stream_zip
+from .pagination import InvalidCursor, paginate, parse_limit
+from .uploads import get_blob_store
 
 platform = Blueprint("platform", __name__, url_prefix="/platform", template_folder="templates", static_folder="static")
 
@@ -36,6 +47,130 @@ def create_project():
   return jsonify(project.serialize())
 
 
+@platform.route("/projects", methods=["GET"])
+@login_required
+def list_projects():
+  """ The user's projects with their files, newest first, paginated with `cursor` and `limit`. """
+  query = Project.query.filter_by(owner_id=current_user.id) \
+    .options(selectinload(Project.files)) # all files of a page in one query
+  try:
+    projects, next_cursor = paginate(query, Project, request.args.get("cursor"),
+      parse_limit(request.args.get("limit")))
+  except InvalidCursor as e:
+    return jsonify({"error": str(e)}), 400
+
+  return jsonify({
+    "projects": [project.serialize() for project in projects],
+    "next_cursor": next_cursor,
+  })
+
+
+@platform.route("/projects/<id_>/files", methods=["GET"])
+@login_required
+def list_project_files(id_):
+  """ The files of a project, newest first, paginated with `cursor` and `limit`. """
+  try:
+    project_id = uuid.UUID(id_)
+  except ValueError:
+    return jsonify({"error": "Malformed id"}), 400
+
+  project = Project.query.filter_by(id=project_id, owner_id=current_user.id).first()
+  if project is None:
+    return jsonify({"error": "Project not found"}), 404
+
+  try:
+    files, next_cursor = paginate(File.query.filter_by(project_id=project_id), File,
+      request.args.get("cursor"), parse_limit(request.args.get("limit")))
+  except InvalidCursor as e:
+    return jsonify({"error": str(e)}), 400
+
+  return jsonify({
+    "files": serialize_files(files),
+    "next_cursor": next_cursor,
+  })
+
+
+@platform.route("/projects/<id_>/deck", methods=["GET"])
+@login_required
+def get_project_deck(id_):
+  """ The summaries of all files of a project, e.g. to load its deck, in one query. """
+  try:
+    project_id = uuid.UUID(id_)
+  except ValueError:
+    return jsonify({"error": "Malformed id"}), 400
+
+  project = Project.query.filter_by(id=project_id, owner_id=current_user.id).first()
+  if project is None:
+    return jsonify({"error": "Project not found"}), 404
+
+  rows = dbs.query(File, FileSummary) \
+    .outerjoin(FileSummary, FileSummary.content_hash == File.content_hash) \
+    .filter(File.project_id == project_id) \
+    .order_by(File.created_on, File.id).all()
+  return jsonify({"files": [{
+    "id": str(file.id),
+    "name": file.name,
+    "content_hash": file.content_hash,
+    **(summary.serialize() if summary is not None else _summary(file.content_hash, {})),
+  } for file, summary in rows]})
+
+
+@platform.route("/projects/<id_>/export", methods=["GET"])
+@login_required
+def export_project(id_):
+  """ Stream a zip of the project and its files, see archive.py. """
+  try:
+    project_id = uuid.UUID(id_)
+  except ValueError:
+    return jsonify({"error": "Malformed id"}), 400
+
+  project = Project.query.filter_by(id=project_id, owner_id=current_user.id).first()
+  if project is None:
+    return jsonify({"error": "Project not found"}), 404
+
+  # Resolve paths now, the response is generated outside of the request context.
+  files = File.query.filter_by(project_id=project_id).order_by(File.created_on, File.id).all()
+  paths = [(f.name, get_blob_store().path(f.content_hash) if f.content_hash is not None
+                    else get_file_path(f.project_id, f.name)) for f in files]
+
+  response = Response(stream_zip(project.name, paths), mimetype="application/zip")
+  response.headers["Content-Disposition"] = \
+    f"attachment; filename*=UTF-8''{urllib.parse.quote(project.name)}.zip"
+  return response
+
+
+@platform.route("/projects/import", methods=["POST"])
+@login_required
+def import_project():
+  """ Create a project from an exported zip, uploaded as `archive`. """
+  archive = request.files.get("archive")
+  if archive is None or archive.filename == "":
+    return jsonify({"error": "No archive"}), 400
+
+  try:
+    name, stored = read_zip(archive.stream, get_blob_store(), allowed_file)
+  except InvalidArchive as e:
+    return jsonify({"error": str(e)}), 400
+
+  name = request.form.get("name") or name or archive.filename.rsplit(".", 1)[0]
+  project = Project(id=uuid.uuid4(), name=name[:100], owner_id=current_user.id)
+  file_objects = [File(name=file_name, project_id=project.id, path=get_blob_store().path(digest),
+    content_hash=digest, size=size) for file_name, digest, size in stored]
+  try:
+    dbs.add(project)
+    dbs.flush() # the project row has to exist before its files
+    dbs.add_all(file_objects)
+    dbs.commit()
+  except Exception as e:
+    dbs.rollback()
+    current_app.logger.error(e)
+    return jsonify({"error": "Could not import project"}), 500
+
+  enqueue_parsing(file_objects)
+  q_background.enqueue_call(project_sync.sync, args=(str(current_user.id), [str(project.id)]))
+  return jsonify(project.serialize()), 201
+
+
 @platform.route("/projects/<id_>", methods=["GET"])
 @login_required
 def get_project(id_):
@@ -67,17 +202,42 @@ def allowed_file(filename):
 
 
 def get_file_path(project_id, filename):
+  """ Path of a file that was stored before the blob store. """
   dirs = os.path.join(current_app.config["UPLOAD_DIR"], str(project_id))
-  if not os.path.exists(dirs):
-    os.makedirs(dirs)
   path = os.path.join(dirs, secure_filename(filename))
   path = os.path.abspath(path)
   return path
 
-def store_file(file, project_id):
-  path = get_file_path(project_id, file.filename)
-  file.save(path)
-  return path
+def store_file(file):
+  """ Store an uploaded file in the blob store, returns its path, hash and size. """
+  blob_store = get_blob_store()
+  digest, size = blob_store.put(file.stream)
+  return blob_store.path(digest), digest, size
+
+
+PENDING_SUMMARY = {"status": "pending", "summary": None}
+NO_SUMMARY = {"status": deck_files.UNSUPPORTED, "summary": None} # stored before the blob store
+
+def _summary(content_hash, summaries):
+  if content_hash is None:
+    return NO_SUMMARY
+  return summaries.get(content_hash, PENDING_SUMMARY)
+
+def enqueue_parsing(file_objects):
+  """ Parse new files in the background, each content only once. Returns the known summaries. """
+  summaries = deck_files.get_summaries(dbs, [f.content_hash for f in file_objects])
+  enqueued = set()
+  for f in file_objects:
+    if f.content_hash not in summaries and f.content_hash not in enqueued:
+      q_background.enqueue_call(deck_files.parse_file, args=(f.content_hash, f.path, f.name))
+      enqueued.add(f.content_hash)
+  return summaries
+
+def serialize_files(files, summaries=None):
+  """ Serialize files with their summaries (see lib/deck_files.py), fetched in one query. """
+  if summaries is None:
+    summaries = deck_files.get_summaries(dbs, [f.content_hash for f in files])
+  return [{**f.serialize(), **_summary(f.content_hash, summaries)} for f in files]
 
 
 @platform.route("/files", methods=["POST"])
@@ -100,22 +260,23 @@ def create_files():
     if not (file and allowed_file(file.filename)):
       return jsonify({"error": "Invalid file type for file: " + file.filename}), 400
 
-  # Then store the files
+  # Then store the files, and add them to the project in one transaction
   file_objects = []
   for file in files:
-    f = File(name=file.filename, project_id=project_id)
-    path = store_file(file, project_id)
-    f.path = path
-    try:
-      dbs.add(f)
-      dbs.commit()
-      file_objects.append(f)
-    except Exception as e:
-      dbs.rollback()
-      current_app.logger.error(e)
-      return jsonify({"error": str(e)}), 500
+    path, digest, size = store_file(file)
+    file_objects.append(File(name=file.filename, project_id=project_id, path=path,
+      content_hash=digest, size=size))
+  try:
+    dbs.add_all(file_objects)
+    dbs.commit()
+  except Exception as e:
+    dbs.rollback()
+    current_app.logger.error(e)
+    return jsonify({"error": str(e)}), 500
 
-  return jsonify({"success": True, "files": [f.serialize() for f in file_objects]}), 201
+  summaries = enqueue_parsing(file_objects)
+  q_background.enqueue_call(project_sync.sync, args=(str(current_user.id), [project_id]))
+  return jsonify({"success": True, "files": serialize_files(file_objects, summaries)}), 201
 
 
 @platform.route("/files/<id_>", methods=["GET"])
@@ -127,7 +288,7 @@ def get_file(id_):
     return jsonify({"error": "Malformed id"}), 400
   if file is None:
     return jsonify({"error": "File not found"}), 404
-  return jsonify(file.serialize())
+  return jsonify(serialize_files([file])[0])
 
 
 @platform.route("/files/<id_>/download", methods=["GET"])
@@ -139,5 +300,30 @@ def download_file(id_):
     return jsonify({"error": "Malformed id"}), 400
   if file is None:
     return jsonify({"error": "File not found"}), 404
-  path = get_file_path(file.project_id, file.name)
-  return send_file(path, as_attachment=True)
+
+  if file.content_hash is None: # stored before the blob store
+    return send_file(get_file_path(file.project_id, file.name), as_attachment=True,
+      download_name=file.name, conditional=True)
+
+  # The content of a file never changes, so its hash is a strong etag, and a revalidation needs no
+  # file I/O at all.
+  if request.if_none_match.contains(file.content_hash):
+    response = current_app.response_class(status=304)
+    response.set_etag(file.content_hash)
+    return response
+
+  path = get_blob_store().path(file.content_hash)
+  if DOWNLOAD_ACCEL_PREFIX is not None:
+    # nginx sends the file, and handles ranges and If-Modified-Since.
+    response = current_app.response_class(status=200,
+      mimetype=mimetypes.guess_type(file.name)[0] or "application/octet-stream")
+    response.headers["X-Accel-Redirect"] = \
+      DOWNLOAD_ACCEL_PREFIX.rstrip("/") + "/" + os.path.relpath(path, get_blob_store().root)
+    response.headers["Content-Disposition"] = \
+      f"attachment; filename*=UTF-8''{urllib.parse.quote(file.name)}"
+    response.set_etag(file.content_hash)
+    return response
+
+  # send_file handles If-Modified-Since and Range requests.
+  return send_file(path, as_attachment=True, download_name=file.name, conditional=True,
+    etag=file.content_hash, last_modified=file.created_on)
@@ -0,0 +1,26 @@
+""" Uploads of platform files go straight into the blob store, see lib/blob_store.py. """
+
+from flask import Request
+
+from lib.blob_store import BlobStore
+from lib.conf import UPLOAD_DIR
+
+_blob_store = None
+
+def get_blob_store() -> BlobStore:
+  global _blob_store
+  if _blob_store is None:
+    _blob_store = BlobStore(UPLOAD_DIR)
+  return _blob_store
+
+
+class UploadRequest(Request):
+  """ Werkzeug writes uploaded files to a temporary file while it parses the form. For platform
+  requests, that file is a blob writer, which hashes the upload as it is written, so storing it is a
+  rename instead of a second copy. """
+
+  def _get_file_stream(self, total_content_length, content_type, filename=None,
+    content_length=None):
+    if self.path.startswith("/platform/"):
+      return get_blob_store().writer()
+    return super()._get_file_stream(total_content_length, content_type, filename, content_length)
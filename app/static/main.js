@@ -15,6 +15,15 @@ function hideNotebookMessage() {
   message.style.display = "none";
 }
 
+function showQueuePosition(position) {
+  var status = document.getElementById("notebook-loading-status");
+  if (position > 0) {
+    status.textContent = `The server is busy. You are number ${position} in the queue.`;
+  } else {
+    status.textContent = "Please wait for about 10 seconds";
+  }
+}
+
 function showNotebookStoppedMessage() {
   hideNotebookMessage();
   var message = document.getElementById("notebook-stopped");
@@ -134,6 +143,10 @@ function startMasterWebsocket() {
         loadNotebook(data.notebook_iframe_url);
       }
 
+      if (data.hasOwnProperty("queue_position")) {
+        showQueuePosition(data.queue_position);
+      }
+
       if (data.hasOwnProperty("simulator_url")) {
         loadSimulator(data.simulator_url);
         console.log("Loaded simulator");
@@ -154,6 +167,8 @@ function startMasterWebsocket() {
       loadSimulator(data.url);
     } else if (data.type === "stop-simulator") {
       stopSimulator();
+    } else if (data.type === "queue-position") {
+      showQueuePosition(data.position);
     }
   };
 
@@ -0,0 +1,103 @@
+""" In-process cache of the users that are logged in, for flask-login's user_loader.
+
+Every proxied request is authenticated, so loading the user from the db each time puts the db on the
+proxy hot path. Instead, lightweight `CachedUser` records are kept in a bounded LRU cache with a ttl.
+When a user row changes, its id is published on `CHANNEL`, and every web process drops the entry.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+from typing import Callable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from lib.models import Project, User
+
+CHANNEL = "users.invalidate"
+
+
+class CachedUser:
+  """ The fields of `User` that are needed on every request, detached from the db session. """
+
+  def __init__(self, user: User):
+    self.id = user.id
+    self.first_name = user.first_name
+    self.last_name = user.last_name
+    self.username = user.username
+    self.email = user.email
+    self.can_demo = user.can_demo
+
+  @property
+  def projects(self):
+    return Project.query.filter_by(owner_id=self.id).all()
+
+  # https://github.com/maxcountryman/flask-login/blob/main/src/flask_login/mixins.py
+  @property
+  def is_active(self):
+    return True
+
+  @property
+  def is_authenticated(self):
+    return self.is_active
+
+  @property
+  def is_anonymous(self):
+    return False
+
+  def get_id(self):
+    return str(self.id)
+
+
+class UserCache:
+  def __init__(self, load: Callable[[str], Optional[User]], max_size: int, ttl: float):
+    self.load = load
+    self.max_size = max_size
+    self.ttl = ttl
+    self._users = OrderedDict() # user id -> (expires at, CachedUser)
+    self._lock = threading.Lock()
+
+  def get(self, user_id: str) -> Optional[CachedUser]:
+    with self._lock:
+      entry = self._users.get(user_id)
+      if entry is not None and entry[0] > time.monotonic():
+        self._users.move_to_end(user_id)
+        return entry[1]
+
+    user = self.load(user_id)
+    if user is None:
+      return None
+    cached = CachedUser(user)
+
+    with self._lock:
+      self._users[user_id] = (time.monotonic() + self.ttl, cached)
+      self._users.move_to_end(user_id)
+      while len(self._users) > self.max_size:
+        self._users.popitem(last=False)
+    return cached
+
+  def invalidate(self, user_id: str):
+    with self._lock:
+      self._users.pop(user_id, None)
+
+
+def publish_invalidations(redis_client):
+  """ Publish the ids of users that are updated or deleted, once the change is committed. """
+
+  def mark(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+      session.info.setdefault("invalidated_users", set()).add(str(target.id))
+
+  event.listen(User, "after_update", mark)
+  event.listen(User, "after_delete", mark)
+
+  @event.listens_for(Session, "after_commit")
+  def publish(session):
+    for user_id in session.info.pop("invalidated_users", ()):
+      redis_client.publish(CHANNEL, user_id)
+
+  @event.listens_for(Session, "after_rollback")
+  def discard(session):
+    session.info.pop("invalidated_users", None)
@@ -1,12 +1,18 @@
+import functools
 import json
-import subprocess
-import time
 from typing import Optional
 import uuid
-from lib.models.event import Event
 
-from lib.conf import PRODUCTION, PRINT
+import redis
+
+from lib.conf import PRODUCTION, PRINT, REDIS_HOST
 import lib.cache as cache
+from lib.docker_client import DockerError, get_client as docker
+import lib.docker_index as docker_index
+import lib.event_sink as event_sink
+import lib.images as images
+import lib.queues as queues
+import lib.scheduler as scheduler
 from lib.events import (
   CONTAINER_STARTED,
   CONTAINER_STOPPED,
@@ -17,124 +23,208 @@ from lib.events import (
   CONTAINER_UPGRADE,
   CONTAINER_DESTROYED
 )
-import worker
 
 # utilities for working with docker containers and docker volumes
 
+NOTEBOOK_DIR = "/nb-docker/notebooks"
+
 def get_host_for_user(uid):
   return f"nb-{uid}"
 
 def get_volume_name_for_user(uid):
-  volume_name = f"user-{uid}-volume"
+  """ Name of the user's notebook volume. Users who claimed a pool container keep its volume. """
+  volume_name = docker_index.get_user_volume(uid)
+  if volume_name is None:
+    volume_name = f"user-{uid}-volume"
   return volume_name
 
 def volume_exists_for_user(uid):
-  cmd = "docker volume ls"
-  out = subprocess.run(cmd, shell=True, universal_newlines=True, capture_output=True)
   name = get_volume_name_for_user(uid)
-  return name in out.stdout
+  exists = docker_index.has_volume(name)
+  if exists is None:
+    exists = docker().inspect_volume(name) is not None
+  return exists
 
 def container_exists(name):
-  out = subprocess.run(f"docker top {name}",
-    shell=True, universal_newlines=True, capture_output=True)
-  return not ("No such container" in out.stderr)
+  exists = docker_index.has_container(name)
+  if exists is None:
+    exists = docker().inspect_container(name) is not None
+  return exists
+
+def sync_scheduler(r):
+  """ Count the user containers that are running, and admit queued users if there is room. """
+  running = [name[len("nb-"):] for name in docker().list_containers(all=False)
+             if name.startswith("nb-") and not name.startswith("nb-pool-")]
+  scheduler.sync(r, running)
+  return scheduler.release(r)
+
+def sync_docker_index():
+  """ Seed the index of volumes and containers from docker. """
+  volumes, containers = docker().list_volumes(), docker().list_containers()
+  docker_index.sync(volumes, containers)
+  print(f"synced docker index: {len(volumes)} volumes, {len(containers)} containers")
+
+  # Recover the volumes of users who claimed a pool container, in case redis lost them. Only user
+  # containers without a volume of their own are inspected.
+  volume_names = set(volumes)
+  for name in containers:
+    if not name.startswith("nb-") or name.startswith("nb-pool-"):
+      continue
+    uid = name[len("nb-"):]
+    if f"user-{uid}-volume" in volume_names or docker_index.get_user_volume(uid) is not None:
+      continue
+    volume_name = get_volume_for_container(name)
+    if volume_name is not None and volume_name != f"user-{uid}-volume":
+      docker_index.set_user_volume(uid, volume_name)
 
 def create_volume(uid):
-  volume_name = get_volume_name_for_user(uid)
+  volume_name = f"user-{uid}-volume"
+  docker_index.remove_user_volume(uid) # the volume the user claimed is gone
 
   # Create user directory if it doesn't exist
-  cmd = f"docker volume create {volume_name}"
-  print("creating volume", cmd)
-  out = subprocess.run(cmd, shell=True, universal_newlines=True, capture_output=True)
-  if out.returncode != 0:
-    raise Exception(json.dumps({"msg": "error creating volume", "err": out.stderr, "out": out.stdout}))
-  out = [out.stderr, out.stdout]
+  print("creating volume", volume_name)
+  try:
+    docker().create_volume(volume_name)
+  except DockerError as e:
+    raise Exception(json.dumps({"msg": "error creating volume", "err": str(e)}))
+  docker_index.add_volume(volume_name)
   return volume_name
 
-def create_pod(uid):
-  """ Create a pod and volume for the user, if they don't exist. """
+def get_volume_for_container(name) -> Optional[str]:
+  """ Get the name of the notebook volume mounted in a container. """
+  container = docker().inspect_container(name)
+  if container is None:
+    return None
+  for mount in container.get("Mounts", []):
+    if mount.get("Destination") == NOTEBOOK_DIR:
+      return mount.get("Name")
+  return None
+
+def create_container(name, volume_name, env=None):
+  """ Create a notebook container with the volume mounted. Returns error message if there is an
+  error. """
+
+  resources = {}
+  if PRODUCTION:
+    resources = {"memory": 768 * 1024 * 1024, "cpus": 1, "runtime": "runsc"}
+
+  print("creating container", name)
+  try:
+    docker().create_container(
+      name=name,
+      image=images.IMAGE_NAME,
+      hostname=name,
+      network="demo_nbs",
+      binds=[f"{volume_name}:{NOTEBOOK_DIR}:rw"],
+      platform="linux/amd64",
+      env=env,
+      **resources)
+  except DockerError as e:
+    print(json.dumps({"msg": "error creating container", "err": str(e)}))
+    return "error creating container"
+
+  docker_index.add_container(name)
+  return None
+
+def create_pod(uid, volume_name=None):
+  """ Create a pod and volume for the user, if they don't exist. `volume_name` can be used to reuse
+  the volume of a previous container (it may be a pool volume, see lib.pool). """
+
+  container_name = get_host_for_user(uid)
+  if container_exists(container_name):
+    return None
+
+  if volume_name is None:
+    if not volume_exists_for_user(uid):
+      volume_name = create_volume(uid)
+    else:
+      volume_name = get_volume_name_for_user(uid)
 
-  if not volume_exists_for_user(uid):
-    volume_name = create_volume(uid)
-  else:
-    volume_name = get_volume_name_for_user(uid)
+  return create_container(container_name, volume_name)
 
-  # create container
+def recreate_container(uid) -> Optional[str]:
+  """ Replace the user's stopped container by one from the current image, keeping its volume.
+  Returns error message if there is an error. """
   container_name = get_host_for_user(uid)
-  if not container_exists(container_name):
-    sandbox = ""
-    resources = ""
-    if PRODUCTION:
-      ram = "768m"
-      cpu = 1
-      sandbox = "--runtime=runsc"
-      resources = f"-m {ram} --cpus={cpu}"
-
-    name = f"--name={container_name}"
-    network = "--net=demo_nbs"
-    hostname = f"--hostname={get_host_for_user(uid)}"
-    volume = f"-v {volume_name}:/nb-docker/notebooks:rw"
-    platform = "--platform linux/amd64"
-    cmd = f"docker create {name} {platform} {resources} {sandbox} {network} {hostname} {volume} nb-simple"
-    print(cmd)
-    out = subprocess.run(cmd, universal_newlines=True, capture_output=True, shell=True)
-
-    if out.returncode != 0:
-      print(json.dumps({"msg": "error creating container", "err": out.stderr, "out": out.stdout}))
-      return "error creating container"
-
-  return None #["created volume", p.stderr, p.stdout, out]
+  volume_name = get_volume_for_container(container_name)
+  print("removing container", container_name)
+  try:
+    docker().remove_container(container_name)
+  except DockerError as e:
+    print("error removing container", e)
+    return "error removing container"
+  docker_index.remove_container(container_name)
+
+  return create_pod(uid, volume_name=volume_name)
+
+def release_slot(uid):
+  """ Give back the scheduler slot of a container that did not start (no die event will release it),
+  and start the users that are admitted in its place. """
+  admitted = scheduler.release(docker_index.get_redis(), uid)
+  if len(admitted) > 0:
+    # rq needs a connection that doesn't decode responses
+    q = queues.interactive(redis.StrictRedis(host=REDIS_HOST, port=6379, db=0))
+    for admitted_uid in admitted:
+      q.enqueue_call(run_pod, args=(admitted_uid,))
 
 def run_pod(uid: uuid.uuid4) -> Optional[str]:
   """ Run a pod that exists. Returns error message if there is an error. """
+  try:
+    err = _run_pod(uid)
+  except Exception:
+    release_slot(uid)
+    raise
+  if err is not None:
+    release_slot(uid)
+  return err
 
-  assert volume_exists_for_user(uid), f"volume doesn't exist for {uid} (run_pod)"
+def _run_pod(uid) -> Optional[str]:
   assert container_exists(get_host_for_user(uid)), f"container doesn't exist for {uid} (run_pod)"
 
-  cmd = f"docker start {get_host_for_user(uid)}"
-  print(cmd)
-  subprocess.run(cmd, shell=True, universal_newlines=True)
+  # Containers that were stopped when the image was updated are upgraded when they start again.
+  r = docker_index.get_redis()
+  container = docker().inspect_container(get_host_for_user(uid))
+  current_image = images.current_id(r)
+  if container is not None and current_image is not None and container["Image"] != current_image:
+    print("upgrading container", get_host_for_user(uid))
+    save_event(r, uid, CONTAINER_UPGRADE)
+    err = recreate_container(uid)
+    if err:
+      return err
+
+  print("starting container", get_host_for_user(uid))
+  try:
+    docker().start_container(get_host_for_user(uid))
+  except DockerError as e:
+    print(json.dumps({"msg": "error starting container", "err": str(e)}))
+    return "error starting container"
+
+def get_container_image(r, uid) -> Optional[str]:
+  """ Image id of the user's container, cached until the container stops. """
+  image = cache.get(r, cache.keys.image, uid)
+  if image is None:
+    container = docker().inspect_container(get_host_for_user(uid))
+    if container is None:
+      return None
+    image = container["Image"]
+    cache.set(r, cache.keys.image, image, uid)
+  return image.decode("utf-8") if isinstance(image, bytes) else image
 
 # event handling
 def get_pubsub_channel_name(uid):
   return f"user-{uid}"
 
-def monitor_container(uid):
-  print("monitoring container" * 10)
-  container_name = get_host_for_user(uid)
-  cmd = f"docker logs {container_name} --follow --since 5s"
-  print(cmd)
-  p = subprocess.Popen(cmd, shell=True, universal_newlines=True,
-    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-  while True:
-    line = p.stderr.readline()
-
-    if PRINT: print("line:", line, end="")
-    if "error" in line.lower():
-      return line
-
-    if line is not None and "is running at:" in line:
-      with worker.get_redis() as r, worker.get_db_session() as session:
-        time.sleep(0.5) # give it a little time, should not be needed, but beyond our control
-        handle_notebook_started(r, session, uid)
-      break
-
-    time.sleep(0.0001)
+def notebook_ready(r, uid):
+  """ Called by the readiness watcher when the notebook server of a user's container is ready. """
+  handle_notebook_started(r, uid)
 
 # event response handlers
 
-def save_event_db(session, uid, event):
-  # save event to db
-  e = Event(code=event, uid=uid)
-  try:
-    session.add(e)
-    session.commit()
-  except Exception as e:
-    print("error saving event to db", e)
-    session.rollback()
+def save_event(r, uid, event):
+  # queue event, it is written to the db in a batch by the monitor (lib.event_sink)
+  event_sink.record(r, uid, event)
 
-def handle_container_started(r, session, uid, q):
+def handle_container_started(r, uid, readiness):
   print("HANDLER: handle_container_started")
   channel = get_pubsub_channel_name(uid)
 
@@ -142,54 +232,61 @@ def handle_container_started(r, session, uid, q):
   # TODO: this is not really supposed to be handled by the monitor. It should be handled by the
   # worker starting the container, but how do we get the data from the worker to the browser?
   # should it send a pubsub message?
-  update_available, err = check_update_available(uid)
+  update_available, err = check_update_available(r, uid)
   if err is not None:
     # we don't really care if there is an error here, just log it
     print("error checking for update", err)
 
+  # the notebook and simulator of a new container are not running until they report it
+  cache.set_many(r, {
+    cache.keys.container_running: 1,
+    cache.keys.notebook_running: 0,
+    cache.keys.simulator_running: 0}, uid)
   r.publish(channel, json.dumps({"event": CONTAINER_STARTED, "update_available": update_available}))
-  cache.set(r, cache.keys.container_running, 1, uid)
+  scheduler.mark_running(r, uid)
 
-  # Start worker task to monitor container during startup to detect notebook startup
-  q.enqueue_call(monitor_container, args=(uid,))
+  # Watch the container during startup to detect notebook startup
+  readiness.watch(get_host_for_user(uid), functools.partial(notebook_ready, r, uid))
 
-  save_event_db(session, uid, CONTAINER_STARTED)
+  save_event(r, uid, CONTAINER_STARTED)
 
-def handle_notebook_started(r, session, uid):
+def handle_notebook_started(r, uid):
   print("HANDLER: handle_notebook_started")
   channel = get_pubsub_channel_name(uid)
   cache.set(r, cache.keys.notebook_running, 1, uid)
   r.publish(channel, json.dumps({"event": NOTEBOOK_STARTED}))
 
-  save_event_db(session, uid, NOTEBOOK_STARTED)
+  save_event(r, uid, NOTEBOOK_STARTED)
 
-def handle_simulator_started(r, session, uid):
+def handle_simulator_started(r, uid):
   print("HANDLER: handle_simulator_started")
   channel = get_pubsub_channel_name(uid)
   cache.set(r, cache.keys.simulator_running, 1, uid)
   r.publish(channel, json.dumps({"event": SIMULATION_FILE_SERVER_STARTED}))
 
-  save_event_db(session, uid, SIMULATION_FILE_SERVER_STARTED)
+  save_event(r, uid, SIMULATION_FILE_SERVER_STARTED)
 
-def handle_container_stopped(r, session, uid):
+def handle_container_stopped(r, uid):
   print("HANDLER: handle_container_stopped")
   channel = get_pubsub_channel_name(uid)
-  handle_notebook_stopped(r, session, uid)
-  handle_simulator_stopped(r, session, uid)
-  cache.set(r, cache.keys.container_running, 0, uid)
-  r.publish(channel, json.dumps({"event": CONTAINER_STOPPED}))
-
-  save_event_db(session, uid, CONTAINER_STOPPED)
-
-def handle_notebook_stopped(r, session, uid):
+  # one atomic update of the user's state, then the events of everything that stopped with it
+  cache.set_many(r, {
+    cache.keys.container_running: 0,
+    cache.keys.notebook_running: 0,
+    cache.keys.simulator_running: 0}, uid, delete=(cache.keys.image,))
+  for event in (NOTEBOOK_STOPPED, SIMULATION_FILE_SERVER_STOPPED, CONTAINER_STOPPED):
+    r.publish(channel, json.dumps({"event": event}))
+    save_event(r, uid, event)
+
+def handle_notebook_stopped(r, uid):
   print("HANDLER: handle_notebook_stopped")
   channel = get_pubsub_channel_name(uid)
   cache.set(r, cache.keys.notebook_running, 0, uid)
   r.publish(channel, json.dumps({"event": NOTEBOOK_STOPPED}))
 
-  save_event_db(session, uid, NOTEBOOK_STOPPED)
+  save_event(r, uid, NOTEBOOK_STOPPED)
 
-def handle_simulator_stopped(r, session, uid):
+def handle_simulator_stopped(r, uid):
   print("HANDLER: handle_simulator_stopped")
   channel = get_pubsub_channel_name(uid)
   r.publish(
@@ -199,37 +296,27 @@ def handle_simulator_stopped(r, session, uid):
     }))
   cache.set(r, cache.keys.simulator_running, 0, uid)
 
-  save_event_db(session, uid, SIMULATION_FILE_SERVER_STOPPED)
+  save_event(r, uid, SIMULATION_FILE_SERVER_STOPPED)
 
-def handle_container_destroyed(r, session, uid):
-  save_event_db(session, uid, CONTAINER_DESTROYED)
+def handle_container_destroyed(r, uid):
+  save_event(r, uid, CONTAINER_DESTROYED)
 
-def check_update_available(uid): # -> Tuple[bool, Optional[str]]:
+def check_update_available(r, uid): # -> Tuple[bool, Optional[str]]:
   """ Check if there is an update available. """
 
-  IMAGE_NAME = "nb-simple"
-
-  # Get the current image's hash
-  cmd = f"docker image inspect {IMAGE_NAME}"
-  print(cmd)
-  out = subprocess.run(cmd, shell=True, universal_newlines=True, capture_output=True)
-  if out.returncode != 0:
-    print("error getting image info", out.stderr)
+  # Get the current image's hash, cached until the image changes (see lib.images)
+  current_image_hash = images.current_id(r)
+  if current_image_hash is None:
     return False, "error getting image info"
-  current_image_hash = json.loads(out.stdout)[0]["Id"]
-
-  # Get docker container image id hash
-  container_name = get_host_for_user(uid)
-  cmd = f"docker inspect {container_name}"
-  print(cmd)
-  out = subprocess.run(cmd, universal_newlines=True, capture_output=True, shell=True)
-
-  if out.returncode != 0:
-    print(json.dumps({"msg": "error inspecting container", "err": out.stderr, "out": out.stdout}))
-    return False, "error creating container"
 
-  data = json.loads(out.stdout)
-  image_hash = data[0]["Image"]
+  # Get docker container image id hash, cached while the container runs
+  try:
+    image_hash = get_container_image(r, uid)
+  except DockerError as e:
+    print(json.dumps({"msg": "error inspecting container", "err": str(e)}))
+    image_hash = None
+  if image_hash is None:
+    return False, "error inspecting container"
 
   if current_image_hash != image_hash:
     return True, None
@@ -239,28 +326,20 @@ def check_update_available(uid): # -> Tuple[bool, Optional[str]]:
 def update_container(uid):
   container_name = get_host_for_user(uid)
 
-  with worker.get_db_session() as session:
-    save_event_db(session, uid, CONTAINER_UPGRADE)
+  # runs in the worker and in upgrade_containers.py (web image), which has no `worker` module
+  save_event(docker_index.get_redis(), uid, CONTAINER_UPGRADE)
 
   # Stop the current container
-  cmd = f"docker stop {container_name}"
-  print(cmd)
-  out = subprocess.run(cmd, shell=True, universal_newlines=True, capture_output=True)
-  if out.returncode != 0:
-    print("error stopping container", out.stderr)
+  print("stopping container", container_name)
+  try:
+    docker().stop_container(container_name)
+  except DockerError as e:
+    print("error stopping container", e)
     raise Exception("error stopping container")
 
-  # Delete the current container
-  cmd = f"docker rm {container_name}"
-  print(cmd)
-  out = subprocess.run(cmd, shell=True, universal_newlines=True, capture_output=True)
-  if out.returncode != 0:
-    print("error removing container", out.stderr)
-    raise Exception("error removing container")
-
-  # Create and start a new container
+  # Replace the container, keeping its volume, and start it.
   # This will be picked up by the monitor, and then appropriate events will be sent to the client
-  err = create_pod(uid)
+  err = recreate_container(uid)
   if err:
     raise Exception("upgrade: error creating pod" + str(err))
 
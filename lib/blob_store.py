@@ -0,0 +1,88 @@
+""" Content-addressable storage of uploaded files.
+
+Files are stored once per unique content, at `<root>/<hash[:2]>/<hash[2:4]>/<hash>` where the hash is
+the sha256 of the content, and `File` rows refer to them by hash. Uploads are hashed while they are
+written to a temporary file (see `BlobWriter`), which is then renamed to its final path, or dropped
+if the content is already stored.
+"""
+
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, Tuple
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobWriter:
+  """ A temporary file that hashes what is written to it. It is removed on close unless it was
+  committed to the store. """
+
+  def __init__(self, tmp_dir: str):
+    self._file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+    self._hash = hashlib.sha256()
+    self.size = 0
+    self.committed = False
+
+  def write(self, data: bytes) -> int:
+    self._hash.update(data)
+    self.size += len(data)
+    return self._file.write(data)
+
+  def hexdigest(self) -> str:
+    return self._hash.hexdigest()
+
+  @property
+  def name(self) -> str:
+    return self._file.name
+
+  def close(self):
+    if not self._file.closed:
+      self._file.close()
+    if not self.committed:
+      try: os.remove(self._file.name)
+      except OSError: pass
+
+  def __getattr__(self, name): # seek, read, flush, ... for werkzeug's FileStorage
+    return getattr(self._file, name)
+
+
+class BlobStore:
+  def __init__(self, root: str):
+    self.root = root
+    self.tmp_dir = os.path.join(root, "tmp")
+    os.makedirs(self.tmp_dir, exist_ok=True)
+
+  def path(self, digest: str) -> str:
+    return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+  def exists(self, digest: str) -> bool:
+    return os.path.exists(self.path(digest))
+
+  def writer(self) -> BlobWriter:
+    return BlobWriter(self.tmp_dir)
+
+  def commit(self, writer: BlobWriter) -> Tuple[str, int]:
+    """ Move the content of a writer into the store. Returns its hash and size. """
+    writer.flush()
+    digest = writer.hexdigest()
+    path = self.path(digest)
+    if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      os.chmod(writer.name, 0o644) # temporary files are private
+      os.replace(writer.name, path) # atomic, a concurrent upload of the same content is harmless
+      writer.committed = True
+    writer.close()
+    return digest, writer.size
+
+  def put(self, stream: BinaryIO) -> Tuple[str, int]:
+    """ Store the content of a stream. Returns its hash and size. """
+    if isinstance(stream, BlobWriter):
+      return self.commit(stream)
+    writer = self.writer()
+    try:
+      for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        writer.write(chunk)
+      return self.commit(writer)
+    finally:
+      writer.close()
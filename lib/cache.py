@@ -1,18 +1,38 @@
-""" thread safe cache (in redis) """
+""" thread safe cache (in redis), one hash per user """
 
+from typing import Dict, Iterable, Optional
 from uuid import UUID
 
 from redis import StrictRedis
 
+from lib.conf import CACHE_TTL
+
 class keys:
   container_running = "container_running"
   notebook_running = "notebook_running"
   simulator_running = "simulator_running"
+  image = "image" # image id of the user's container, while it runs
+
+def _redis_key(uid: UUID): return f"demo.{uid}"
+
+def set_many(r: StrictRedis, mapping: Dict[str, object], uid: UUID, ttl: Optional[int] = CACHE_TTL,
+  delete: Iterable[str] = ()):
+  """ Set multiple fields (and delete the `delete` fields) atomically, and refresh the ttl if there
+  is one. """
+  delete = list(delete)
+  with r.pipeline() as pipe:
+    pipe.hset(_redis_key(uid), mapping=mapping)
+    if len(delete) > 0:
+      pipe.hdel(_redis_key(uid), *delete)
+    if ttl is not None:
+      pipe.expire(_redis_key(uid), ttl)
+    pipe.execute()
+
+def set(r: StrictRedis, key: str, value, uid: UUID, ttl: Optional[int] = CACHE_TTL):
+  set_many(r, {key: value}, uid, ttl=ttl)
 
-def _redis_key(key: str, uid: UUID): return f"demo.{uid}.{key}"
-def set(r: StrictRedis, key: str, value, uid: UUID): r.set(_redis_key(key, uid), value)
-def get(r: StrictRedis, key: str, uid: UUID): return r.get(_redis_key(key, uid))
-def has(r: StrictRedis, key: str, uid: UUID): return r.exists(_redis_key(key, uid))
-def del_(r: StrictRedis, key: str, uid: UUID): return r.delete(_redis_key(key, uid))
-def clear(r: StrictRedis, uid: UUID):
-  for k in r.scan_iter(f"demo.{uid}"): r.delete(k)
+def get(r: StrictRedis, key: str, uid: UUID): return r.hget(_redis_key(uid), key)
+def get_all(r: StrictRedis, uid: UUID) -> dict: return r.hgetall(_redis_key(uid))
+def has(r: StrictRedis, key: str, uid: UUID): return r.hexists(_redis_key(uid), key)
+def del_(r: StrictRedis, key: str, uid: UUID): return r.hdel(_redis_key(uid), key)
+def clear(r: StrictRedis, uid: UUID): return r.unlink(_redis_key(uid))
@@ -2,3 +2,67 @@ import os
 
 PRODUCTION = os.getenv("PRODUCTION") in ["1", "True", "true"]
 PRINT = not PRODUCTION
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+
+# "api" talks to the Docker Engine API over the socket, "cli" shells out to the docker binary.
+DOCKER_BACKEND = os.getenv("DOCKER_BACKEND", "api")
+DOCKER_SOCKET = os.getenv("DOCKER_SOCKET", "/var/run/docker.sock")
+
+# Number of pre-started notebook containers to keep ready for new users, 0 disables the pool.
+POOL_SIZE = int(os.getenv("POOL_SIZE", "0"))
+
+# Maximum number of user containers running at the same time, 0 for no limit, see lib.scheduler.
+MAX_RUNNING_CONTAINERS = int(os.getenv("MAX_RUNNING_CONTAINERS", "0"))
+
+# rq workers per queue, see worker/worker.py. "simple" workers run jobs in the worker process and keep
+# their redis and db connections, "fork" workers run each job in a forked process.
+WORKER_MODE = os.getenv("WORKER_MODE", "simple")
+INTERACTIVE_WORKERS = int(os.getenv("INTERACTIVE_WORKERS", "2"))
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "1"))
+
+# Password hashing in the web server, see lib/passwords.py. Hashes are computed by PASSWORD_WORKERS
+# processes, logins and signups are rejected while PASSWORD_MAX_PENDING hashes are waiting. Hashes with
+# a different work factor than PASSWORD_ROUNDS are replaced at login, unless PASSWORD_REHASH is off.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "32"))
+PASSWORD_ROUNDS = int(os.getenv("PASSWORD_ROUNDS", "12"))
+PASSWORD_REHASH = os.getenv("PASSWORD_REHASH", "1") in ["1", "True", "true"]
+
+# Failed logins allowed per IP address and per email in a window of seconds. Successful logins are not
+# counted, so a workshop behind one NAT can log in at once.
+LOGIN_FAILURES_PER_IP = int(os.getenv("LOGIN_FAILURES_PER_IP", "50"))
+LOGIN_FAILURES_PER_EMAIL = int(os.getenv("LOGIN_FAILURES_PER_EMAIL", "10"))
+LOGIN_THROTTLE_WINDOW = int(os.getenv("LOGIN_THROTTLE_WINDOW", "600"))
+
+# Port of the /metrics endpoint of the worker and the monitor, see lib/metrics.py.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Seconds to wait for the notebook server in a starting container, see lib.readiness.
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "120"))
+
+# Lifecycle events are written to the db in batches, see lib.event_sink.
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "2"))
+
+# Number of threads handling docker events in the monitor, events of one container stay in order.
+MONITOR_SHARDS = int(os.getenv("MONITOR_SHARDS", "8"))
+
+# Seconds after the last update that a user's cached state expires, unset for no expiry.
+CACHE_TTL = int(os.environ["CACHE_TTL"]) if "CACHE_TTL" in os.environ else None
+
+# In-process cache of logged in users in the web server, see app/user_cache.py.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# Content-addressable store of files uploaded to the platform, see lib/blob_store.py.
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/data/uploads")
+
+# Path prefix of an internal nginx location that serves UPLOAD_DIR. When set, file downloads are handed
+# to nginx with X-Accel-Redirect instead of being sent by the web server.
+DOWNLOAD_ACCEL_PREFIX = os.getenv("DOWNLOAD_ACCEL_PREFIX")
+
+# Shared cache of static assets served by the notebook containers, see app/demo/asset_cache.py.
+ASSET_CACHE_DIR = os.getenv("ASSET_CACHE_DIR", "/tmp/asset-cache")
+ASSET_CACHE_MEMORY_BYTES = int(os.getenv("ASSET_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+ASSET_CACHE_DISK_BYTES = int(os.getenv("ASSET_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
@@ -0,0 +1,141 @@
+""" Summaries of Hamilton deck and resource files uploaded to the platform.
+
+Deck layouts (.lay) and resource definitions (.tml, .ctr, .rck) are HxCfg files: a header line, then
+data sections of `key, value` pairs. Layouts list the labware on the deck as `Labware.<n>.<field>`
+entries, where labware with the "default" template is placed on the deck (carriers), and other
+labware on a site of its template (plates and tips on carriers).
+
+Each unique file content is parsed once, in a background job when it is uploaded, and the summary is
+stored in `file_summaries` keyed by content hash. Binary HxCfg files are not parsed.
+"""
+
+import re
+from typing import Dict, List, Optional
+
+from sqlalchemy import exc
+
+from lib.models import FileSummary
+import worker
+
+PARSER_VERSION = 1
+MAX_SIZE = 16 * 1024 * 1024 # larger files are not deck files
+
+PARSED = "parsed"
+UNSUPPORTED = "unsupported"
+FAILED = "failed"
+
+_ENTRY = re.compile(r'^\s*([A-Za-z_][\w.\-]*)\s*,\s*"?(.*?)"?\s*,?\s*$')
+
+# fields of resource definitions that are worth summarizing
+_RESOURCE_FIELDS = {
+  "Dim.Dx": "size_x",
+  "Dim.Dy": "size_y",
+  "Dim.Dz": "size_z",
+  "Site.Cnt": "num_sites",
+  "Rows": "num_rows",
+  "Columns": "num_columns",
+  "Description": "description",
+}
+
+
+def _number(value: str):
+  try:
+    return float(value)
+  except ValueError:
+    return value
+
+def parse_entries(text: str) -> Dict[str, str]:
+  """ All `key, value` pairs of an HxCfg text file. """
+  entries = {}
+  for line in text.splitlines():
+    match = _ENTRY.match(line)
+    if match is not None:
+      entries[match.group(1)] = match.group(2)
+  return entries
+
+def summarize_layout(entries: Dict[str, str]) -> dict:
+  labware = {} # n -> fields
+  for key, value in entries.items():
+    parts = key.split(".", 2)
+    if parts[0] == "Labware" and len(parts) == 3:
+      labware.setdefault(parts[1], {})[parts[2]] = value
+
+  carriers: List[dict] = []
+  placed: List[dict] = []
+  for n in sorted(labware, key=lambda n: int(n) if n.isdigit() else 0):
+    fields = labware[n]
+    item = {
+      "id": fields.get("Id"),
+      "file": fields.get("File"),
+      "site": fields.get("SiteId"),
+    }
+    if fields.get("Template", "default") == "default":
+      item["position"] = {axis.lower(): _number(fields[f"TForm.3.{axis}"])
+                          for axis in "XYZ" if f"TForm.3.{axis}" in fields}
+      carriers.append(item)
+    else:
+      item["carrier"] = fields.get("Template")
+      placed.append(item)
+
+  return {"type": "layout", "carriers": carriers, "labware": placed}
+
+def summarize_resource(entries: Dict[str, str], kind: str) -> dict:
+  summary = {"type": kind}
+  for key, name in _RESOURCE_FIELDS.items():
+    if key in entries:
+      summary[name] = _number(entries[key])
+  return summary
+
+def parse(data: bytes, name: str) -> dict:
+  """ Returns {"status": ..., "summary": ...} for a file's content. """
+  extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+  if extension not in ("lay", "tml", "ctr", "rck"):
+    return {"status": UNSUPPORTED, "summary": None}
+  try:
+    text = data.decode("latin-1")
+  except UnicodeDecodeError:
+    return {"status": UNSUPPORTED, "summary": None}
+  if not text.startswith("HxCfgFile"): # binary HxCfg
+    return {"status": UNSUPPORTED, "summary": None}
+
+  entries = parse_entries(text)
+  if extension == "lay":
+    summary = summarize_layout(entries)
+  else:
+    summary = summarize_resource(entries, {"tml": "labware", "ctr": "carrier", "rck": "rack"}[extension])
+  return {"status": PARSED, "summary": summary}
+
+
+def parse_file(content_hash: str, path: str, name: str):
+  """ Parse a stored file and save its summary, unless its content was parsed before. (rq job) """
+  with worker.get_db_session() as session:
+    existing = session.query(FileSummary).filter_by(content_hash=content_hash).first()
+    if existing is not None and existing.parser_version >= PARSER_VERSION:
+      return
+
+    try:
+      with open(path, "rb") as f:
+        data = f.read(MAX_SIZE + 1)
+      result = parse(data, name) if len(data) <= MAX_SIZE else {"status": UNSUPPORTED, "summary": None}
+    except Exception as e:
+      print("error parsing", name, content_hash, e)
+      result = {"status": FAILED, "summary": None}
+
+    if existing is None:
+      existing = FileSummary(content_hash=content_hash)
+      session.add(existing)
+    existing.status = result["status"]
+    existing.summary = result["summary"]
+    existing.parser_version = PARSER_VERSION
+    try:
+      session.commit()
+    except exc.IntegrityError: # parsed by another job in the meantime
+      session.rollback()
+
+def get_summaries(session, content_hashes) -> Dict[str, Optional[dict]]:
+  """ Summaries by content hash, in one query. Hashes that are not parsed (yet) are missing. """
+  content_hashes = [h for h in set(content_hashes) if h is not None]
+  if len(content_hashes) == 0:
+    return {}
+  rows = session.query(FileSummary).filter(FileSummary.content_hash.in_(content_hashes)).all()
+  return {row.content_hash: row.serialize() for row in rows}
@@ -0,0 +1,311 @@
+""" Docker clients used by lib.
+
+`DockerAPI` talks to the Docker Engine API over the unix socket and keeps one keep-alive connection
+per thread. `DockerCLI` shells out to the docker binary. Both expose the same methods and return
+parsed results, so they can be swapped with `DOCKER_BACKEND`.
+"""
+
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+from typing import BinaryIO, Dict, Iterator, List, Optional
+import urllib.parse
+
+from lib.conf import DOCKER_BACKEND, DOCKER_SOCKET, PRINT
+
+
+class DockerError(Exception):
+  def __init__(self, message: str, status: Optional[int] = None):
+    super().__init__(message)
+    self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  """ HTTP connection over a unix socket. """
+
+  def __init__(self, socket_path: str, timeout: float = 60):
+    super().__init__("localhost", timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    sock.connect(self.socket_path)
+    self.sock = sock
+
+
+class DockerAPI:
+  """ Client for the Docker Engine API. """
+
+  def __init__(self, socket_path: str = DOCKER_SOCKET, timeout: float = 60):
+    self.socket_path = socket_path
+    self.timeout = timeout
+    self._local = threading.local()
+
+  def _connection(self) -> UnixHTTPConnection:
+    # Connections are per thread, and must not be shared with a forked child (rq work horses).
+    conn = getattr(self._local, "conn", None)
+    if conn is None or self._local.pid != os.getpid():
+      conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+      self._local.conn = conn
+      self._local.pid = os.getpid()
+    return conn
+
+  def _reset(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is not None:
+      conn.close()
+    self._local.conn = None
+
+  def request(self, method: str, path: str, params: Optional[dict] = None, body=None,
+    content_type: Optional[str] = None, content_length: Optional[int] = None):
+    """ Make a request, returns (status, parsed body). Retries once if the keep-alive connection was
+    closed by the daemon. The body is sent as json, unless a `content_type` is given, in which case
+    it is sent as is (bytes or a file object of `content_length` bytes). """
+
+    if params:
+      path = f"{path}?{urllib.parse.urlencode(params)}"
+    headers = {}
+    if body is not None and content_type is None:
+      body = json.dumps(body)
+      headers["Content-Type"] = "application/json"
+    elif content_type is not None:
+      headers["Content-Type"] = content_type
+      if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+
+    for attempt in range(2):
+      conn = self._connection()
+      if hasattr(body, "seek"):
+        body.seek(0) # a retry sends the file again
+      try:
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        break
+      except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+        self._reset()
+        if attempt == 1:
+          raise
+      except Exception:
+        self._reset()
+        raise
+
+    if PRINT: print("docker api:", method, path, resp.status)
+    if resp.getheader("Content-Type", "").startswith("application/json") and data:
+      data = json.loads(data)
+    elif isinstance(data, bytes):
+      data = data.decode("utf-8", errors="replace")
+
+    if resp.status >= 400:
+      message = data.get("message") if isinstance(data, dict) else data
+      raise DockerError(f"{method} {path}: {resp.status} {message}", status=resp.status)
+
+    return resp.status, data
+
+  def _inspect(self, path: str) -> Optional[dict]:
+    try:
+      return self.request("GET", path)[1]
+    except DockerError as e:
+      if e.status == 404:
+        return None
+      raise
+
+  def inspect_volume(self, name: str) -> Optional[dict]:
+    return self._inspect(f"/volumes/{name}")
+
+  def create_volume(self, name: str) -> dict:
+    return self.request("POST", "/volumes/create", body={"Name": name})[1]
+
+  def remove_volume(self, name: str):
+    self.request("DELETE", f"/volumes/{name}")
+
+  def inspect_container(self, name: str) -> Optional[dict]:
+    return self._inspect(f"/containers/{name}/json")
+
+  def create_container(self, name: str, image: str, hostname: Optional[str] = None,
+    network: Optional[str] = None, binds: Optional[List[str]] = None, memory: Optional[int] = None,
+    cpus: Optional[float] = None, runtime: Optional[str] = None,
+    platform: Optional[str] = None, env: Optional[List[str]] = None) -> dict:
+    host_config = {}
+    if binds: host_config["Binds"] = binds
+    if network: host_config["NetworkMode"] = network
+    if memory: host_config["Memory"] = memory
+    if cpus: host_config["NanoCpus"] = int(cpus * 1e9)
+    if runtime: host_config["Runtime"] = runtime
+
+    body = {"Image": image, "HostConfig": host_config}
+    if hostname: body["Hostname"] = hostname
+    if env: body["Env"] = env
+
+    params = {"name": name}
+    if platform: params["platform"] = platform
+    return self.request("POST", "/containers/create", params=params, body=body)[1]
+
+  def start_container(self, name: str):
+    self.request("POST", f"/containers/{name}/start")
+
+  def stop_container(self, name: str):
+    self.request("POST", f"/containers/{name}/stop")
+
+  def remove_container(self, name: str):
+    self.request("DELETE", f"/containers/{name}")
+
+  def rename_container(self, name: str, new_name: str):
+    self.request("POST", f"/containers/{name}/rename", params={"name": new_name})
+
+  def inspect_image(self, name: str) -> Optional[dict]:
+    return self._inspect(f"/images/{name}/json")
+
+  def events(self, filters: Dict[str, List[str]], since: Optional[str] = None) -> Iterator[dict]:
+    """ Stream events, on a connection of its own. Ends when the daemon closes the stream. """
+    params = {"filters": json.dumps(filters)}
+    if since is not None: params["since"] = since
+    conn = UnixHTTPConnection(self.socket_path, timeout=None)
+    try:
+      conn.request("GET", f"/events?{urllib.parse.urlencode(params)}")
+      resp = conn.getresponse()
+      if resp.status >= 400:
+        raise DockerError(f"GET /events: {resp.status} {resp.read()}", status=resp.status)
+      while True:
+        line = resp.readline()
+        if not line:
+          return
+        if line.strip():
+          yield json.loads(line)
+    finally:
+      conn.close()
+
+  def list_volumes(self) -> List[str]:
+    volumes = self.request("GET", "/volumes")[1].get("Volumes") or []
+    return [v["Name"] for v in volumes]
+
+  def list_containers(self, all: bool = True) -> List[str]:
+    containers = self.request("GET", "/containers/json", params={"all": int(all)})[1]
+    return [name.lstrip("/") for c in containers for name in c.get("Names", [])]
+
+  def put_archive(self, name: str, path: str, tar: BinaryIO, size: int):
+    """ Extract a tar archive into a directory of a (running or stopped) container. """
+    self.request("PUT", f"/containers/{name}/archive", params={"path": path}, body=tar,
+      content_type="application/x-tar", content_length=size)
+
+
+class DockerCLI:
+  """ Client that shells out to the docker binary. """
+
+  def _run(self, cmd: str) -> subprocess.CompletedProcess:
+    if PRINT: print(cmd)
+    return subprocess.run(cmd, shell=True, universal_newlines=True, capture_output=True)
+
+  def _check(self, cmd: str) -> str:
+    out = self._run(cmd)
+    if out.returncode != 0:
+      raise DockerError(json.dumps({"cmd": cmd, "err": out.stderr, "out": out.stdout}))
+    return out.stdout
+
+  def _inspect(self, cmd: str) -> Optional[dict]:
+    out = self._run(cmd)
+    if out.returncode != 0:
+      if "no such" in out.stderr.lower():
+        return None
+      raise DockerError(json.dumps({"cmd": cmd, "err": out.stderr, "out": out.stdout}))
+    return json.loads(out.stdout)[0]
+
+  def inspect_volume(self, name: str) -> Optional[dict]:
+    return self._inspect(f"docker volume inspect {name}")
+
+  def create_volume(self, name: str) -> dict:
+    self._check(f"docker volume create {name}")
+    return {"Name": name}
+
+  def remove_volume(self, name: str):
+    self._check(f"docker volume rm {name}")
+
+  def inspect_container(self, name: str) -> Optional[dict]:
+    return self._inspect(f"docker container inspect {name}")
+
+  def create_container(self, name: str, image: str, hostname: Optional[str] = None,
+    network: Optional[str] = None, binds: Optional[List[str]] = None, memory: Optional[int] = None,
+    cpus: Optional[float] = None, runtime: Optional[str] = None,
+    platform: Optional[str] = None, env: Optional[List[str]] = None) -> dict:
+    args = [f"--name={name}"]
+    if platform: args.append(f"--platform {platform}")
+    if memory: args.append(f"-m {memory}")
+    if cpus: args.append(f"--cpus={cpus}")
+    if runtime: args.append(f"--runtime={runtime}")
+    if network: args.append(f"--net={network}")
+    if hostname: args.append(f"--hostname={hostname}")
+    for bind in binds or []:
+      args.append(f"-v {bind}")
+    for var in env or []:
+      args.append(f"-e {var}")
+    out = self._check(f"docker create {' '.join(args)} {image}")
+    return {"Id": out.strip()}
+
+  def start_container(self, name: str):
+    self._check(f"docker start {name}")
+
+  def stop_container(self, name: str):
+    self._check(f"docker stop {name}")
+
+  def remove_container(self, name: str):
+    self._check(f"docker rm {name}")
+
+  def rename_container(self, name: str, new_name: str):
+    self._check(f"docker rename {name} {new_name}")
+
+  def inspect_image(self, name: str) -> Optional[dict]:
+    return self._inspect(f"docker image inspect {name}")
+
+  def events(self, filters: Dict[str, List[str]], since: Optional[str] = None) -> Iterator[dict]:
+    """ Stream events from `docker events`. Ends when the process exits. """
+    args = ["--format '{{json .}}'"]
+    for key, values in filters.items():
+      for value in values:
+        args.append(f"--filter '{key}={value}'")
+    if since is not None: args.append(f"--since {since}")
+    p = subprocess.Popen(f"docker events {' '.join(args)}", shell=True, universal_newlines=True,
+      stdout=subprocess.PIPE)
+    try:
+      for line in p.stdout:
+        if line.strip():
+          yield json.loads(line)
+    finally:
+      p.kill()
+      p.wait()
+
+  def list_volumes(self) -> List[str]:
+    return self._check("docker volume ls --format '{{.Name}}'").split()
+
+  def list_containers(self, all: bool = True) -> List[str]:
+    return self._check(f"docker ps {'--all' if all else ''} --format '{{{{.Names}}}}'").split()
+
+  def put_archive(self, name: str, path: str, tar: BinaryIO, size: int):
+    cmd = f"docker cp --archive - {name}:{path}" # --archive keeps the owners in the tar
+    if PRINT: print(cmd)
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    tar.seek(0)
+    shutil.copyfileobj(tar, p.stdin)
+    p.stdin.close()
+    err = p.stderr.read()
+    if p.wait() != 0:
+      raise DockerError(json.dumps({"cmd": cmd, "err": err.decode("utf-8", errors="replace")}))
+
+
+_client = None
+
+def get_client():
+  """ Get the docker client for this process, as configured by `DOCKER_BACKEND`. """
+  global _client
+  if _client is None:
+    if DOCKER_BACKEND == "cli":
+      _client = DockerCLI()
+    elif DOCKER_BACKEND == "api":
+      _client = DockerAPI()
+    else:
+      raise ValueError(f"unknown docker backend: {DOCKER_BACKEND}")
+  return _client
@@ -0,0 +1,70 @@
+""" Index of existing docker volumes and containers (in redis).
+
+The monitor seeds the index with a bulk sync at startup and keeps it up to date from docker events.
+lib writes through on its own creates and removes, so lookups right after a create do not depend on
+event lag. Until the first sync, lookups return None and callers fall back to asking docker.
+"""
+
+from typing import Iterable, Optional
+
+import redis
+
+from lib.conf import REDIS_HOST
+
+VOLUMES = "docker.volumes"
+CONTAINERS = "docker.containers"
+SYNCED = "docker.synced"
+USER_VOLUMES = "docker.user_volumes" # uid -> volume name, for users whose volume came from the pool
+
+_redis = None
+
+def get_redis() -> redis.StrictRedis:
+  """ Pooled connection for lib, safe to use after fork. """
+  global _redis
+  if _redis is None:
+    _redis = redis.StrictRedis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+  return _redis
+
+
+def _has(key: str, name: str) -> Optional[bool]:
+  r = get_redis()
+  with r.pipeline(transaction=False) as pipe:
+    pipe.exists(SYNCED)
+    pipe.sismember(key, name)
+    synced, member = pipe.execute()
+  if not synced:
+    return None
+  return bool(member)
+
+def has_volume(name: str) -> Optional[bool]: return _has(VOLUMES, name)
+def has_container(name: str) -> Optional[bool]: return _has(CONTAINERS, name)
+
+def add_volume(name: str): get_redis().sadd(VOLUMES, name)
+def remove_volume(name: str): get_redis().srem(VOLUMES, name)
+def add_container(name: str): get_redis().sadd(CONTAINERS, name)
+def remove_container(name: str): get_redis().srem(CONTAINERS, name)
+
+def get_user_volume(uid) -> Optional[str]: return get_redis().hget(USER_VOLUMES, str(uid))
+def set_user_volume(uid, name: str): get_redis().hset(USER_VOLUMES, str(uid), name)
+def remove_user_volume(uid): get_redis().hdel(USER_VOLUMES, str(uid))
+
+def rename_container(name: str, new_name: str):
+  with get_redis().pipeline() as pipe:
+    pipe.srem(CONTAINERS, name)
+    pipe.sadd(CONTAINERS, new_name)
+    pipe.execute()
+
+
+def _replace(pipe, key: str, names: Iterable[str]):
+  names = list(names)
+  pipe.delete(key)
+  if len(names) > 0:
+    pipe.sadd(key, *names)
+
+def sync(volumes: Iterable[str], containers: Iterable[str]):
+  """ Replace the index with the given volumes and containers, atomically. """
+  with get_redis().pipeline() as pipe:
+    _replace(pipe, VOLUMES, volumes)
+    _replace(pipe, CONTAINERS, containers)
+    pipe.set(SYNCED, 1)
+    pipe.execute()
@@ -0,0 +1,120 @@
+""" Buffered writes of lifecycle events.
+
+`record` pushes an event onto a redis list, which costs one redis round trip wherever the event
+happens (request threads, rq jobs, the monitor). The `EventFlusher`, running in the monitor, drains
+the list and writes the events to the db in batches, with one multi-row insert per batch.
+"""
+
+import datetime
+import json
+import threading
+import time
+import uuid
+
+from sqlalchemy import exc
+
+from lib.conf import EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL
+from lib.models.event import Event
+
+PENDING = "events.pending"
+
+
+def record(r, uid, code):
+  r.rpush(PENDING, json.dumps({
+    "uid": str(uid),
+    "code": code,
+    "created_on": datetime.datetime.utcnow().isoformat(), # the db uses UTC
+  }))
+
+
+class EventFlusher:
+  """ Flush pending events to the db when `batch_size` are pending, or every `interval` seconds. """
+
+  def __init__(self, r, session, batch_size: int = EVENT_BATCH_SIZE,
+    interval: float = EVENT_FLUSH_INTERVAL, poll_interval: float = 0.2):
+    self.r = r
+    self.session = session
+    self.batch_size = batch_size
+    self.interval = interval
+    self.poll_interval = poll_interval
+    self._stopped = threading.Event()
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    """ Stop the flusher and flush everything that is pending. """
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join()
+    while self.flush() > 0:
+      pass
+
+  def _run(self):
+    last_flush = time.monotonic()
+    while not self._stopped.wait(self.poll_interval):
+      try:
+        if self.r.llen(PENDING) >= self.batch_size or time.monotonic() - last_flush >= self.interval:
+          while self.flush() >= self.batch_size:
+            pass
+          last_flush = time.monotonic()
+      except Exception as e:
+        print("error flushing events", e)
+
+  def flush(self) -> int:
+    """ Write one batch of pending events to the db. Returns the number of events written. """
+    with self._lock:
+      with self.r.pipeline() as pipe:
+        pipe.lrange(PENDING, 0, self.batch_size - 1)
+        pipe.ltrim(PENDING, self.batch_size, -1)
+        batch, _ = pipe.execute()
+      if len(batch) == 0:
+        return 0
+
+      rows = []
+      for item in batch:
+        # The batch is already off the list, a malformed event (e.g. of a container whose name is not
+        # nb-<uuid>) is dropped on its own, not with the batch.
+        try:
+          event = json.loads(item)
+          rows.append({
+            "uid": uuid.UUID(event["uid"]),
+            "code": event["code"],
+            "created_on": datetime.datetime.fromisoformat(event["created_on"]),
+          })
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+          print("dropping malformed event", item, e)
+      if len(rows) == 0:
+        return 0
+
+      try:
+        self.session.execute(Event.__table__.insert(), rows) # executemany, multi-row insert
+        self.session.commit()
+      except (exc.IntegrityError, exc.DataError) as e:
+        # A bad row fails the whole batch, write the rows one by one and drop the bad ones.
+        print("error saving events to db, retrying one by one", e)
+        self.session.rollback()
+        return self._insert_one_by_one(rows)
+      except Exception as e:
+        print("error saving events to db", e)
+        self.session.rollback()
+        self.r.lpush(PENDING, *reversed(batch)) # retry with the next flush
+        return 0
+
+      return len(rows)
+
+  def _insert_one_by_one(self, rows) -> int:
+    written = 0
+    for row in rows:
+      try:
+        self.session.execute(Event.__table__.insert(), row)
+        self.session.commit()
+        written += 1
+      except exc.SQLAlchemyError as e:
+        print("error saving event to db, dropping it", row, e)
+        self.session.rollback()
+    return written
@@ -0,0 +1,131 @@
+""" Queries on the `events` table, and its partitions.
+
+`events` is partitioned by month on `created_on`, so time window queries only read the partitions in
+the window, and old months can be detached or dropped as a whole. Within a partition, per-user
+timelines use the (uid, created_on) index and per-event counts the (code, created_on) index.
+
+Partitions are created ahead of time by `ensure_partitions`, which the web server runs at startup and
+the monitor runs periodically. Rows outside the monthly partitions go to `events_default`.
+"""
+
+import datetime
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func, text
+
+from lib.models.event import Event
+
+BUCKETS = ("hour", "day", "week", "month")
+PARTITION_MONTHS_AHEAD = 2
+
+
+def _month(d: datetime.datetime) -> datetime.datetime:
+  return datetime.datetime(d.year, d.month, 1)
+
+def _next_month(d: datetime.datetime) -> datetime.datetime:
+  return datetime.datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+def partition_name(month: datetime.datetime) -> str:
+  return f"events_y{month.year}m{month.month:02d}"
+
+def is_partitioned(connection) -> Optional[bool]:
+  """ Whether `events` is partitioned, None if it doesn't exist. """
+  relkind = connection.execute(text("SELECT relkind FROM pg_class WHERE relname = 'events'"))
+  relkind = relkind.scalar()
+  return None if relkind is None else relkind == "p"
+
+def _create_partitions(connection, start: datetime.datetime, end: datetime.datetime):
+  connection.execute(text("CREATE TABLE IF NOT EXISTS events_default PARTITION OF events DEFAULT"))
+  month = _month(start)
+  while month < end:
+    connection.execute(text(
+      f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF events "
+      f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"))
+    month = _next_month(month)
+
+def ensure_partitions(engine, months_ahead: int = PARTITION_MONTHS_AHEAD):
+  """ Create the partitions for this month and the next `months_ahead` months. """
+  now = datetime.datetime.utcnow()
+  end = _month(now)
+  for _ in range(months_ahead + 1):
+    end = _next_month(end)
+
+  try:
+    with engine.begin() as connection:
+      partitioned = is_partitioned(connection)
+      if partitioned is None:
+        return
+      if not partitioned:
+        print("events is not partitioned, run `python manage_events.py partition`")
+        return
+      _create_partitions(connection, now, end)
+  except Exception as e: # e.g. another process creating the same partition
+    print("error creating event partitions", e)
+
+def maintain_partitions(engine, interval: float = 6 * 60 * 60) -> threading.Thread:
+  """ Run `ensure_partitions` every `interval` seconds, on a thread. """
+  def run():
+    while True:
+      ensure_partitions(engine)
+      time.sleep(interval)
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  return thread
+
+def partition_existing_table(engine, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+  """ Replace an unpartitioned `events` table by a partitioned one with the same rows, in one
+  transaction. The old table is kept as `events_unpartitioned`. Returns the number of rows copied. """
+  with engine.begin() as connection:
+    if is_partitioned(connection) is not False:
+      raise Exception("events doesn't exist or is already partitioned")
+
+    connection.execute(text("ALTER TABLE events RENAME TO events_unpartitioned"))
+    connection.execute(text(
+      "ALTER TABLE events_unpartitioned RENAME CONSTRAINT events_pkey TO events_unpartitioned_pkey"))
+    # (this renames the primary key index too, so that the new table can have `events_pkey`)
+    Event.__table__.create(connection)
+
+    oldest = connection.execute(text("SELECT min(created_on) FROM events_unpartitioned")).scalar()
+    now = datetime.datetime.utcnow()
+    end = _month(now)
+    for _ in range(months_ahead + 1):
+      end = _next_month(end)
+    _create_partitions(connection, oldest or now, end)
+
+    copied = connection.execute(text(
+      "INSERT INTO events (id, created_on, updated_on, code, uid) "
+      "SELECT id, coalesce(created_on, now()), updated_on, code, uid FROM events_unpartitioned"))
+    return copied.rowcount
+
+
+def timeline(session, uid, since: Optional[datetime.datetime] = None,
+  until: Optional[datetime.datetime] = None):
+  """ Query of a user's events, newest first. """
+  query = session.query(Event).filter(Event.uid == uid)
+  if since is not None:
+    query = query.filter(Event.created_on >= since)
+  if until is not None:
+    query = query.filter(Event.created_on < until)
+  return query.order_by(Event.created_on.desc(), Event.id.desc())
+
+def count_per_bucket(session, code: str, since: datetime.datetime, until: datetime.datetime,
+  bucket: str = "hour") -> List[Tuple[datetime.datetime, int]]:
+  """ Number of events with `code` per bucket, e.g. container starts per hour. """
+  if bucket not in BUCKETS:
+    raise ValueError(f"bucket must be one of {BUCKETS}")
+  start = func.date_trunc(bucket, Event.created_on).label("start")
+  return session.query(start, func.count()) \
+    .filter(Event.code == code, Event.created_on >= since, Event.created_on < until) \
+    .group_by(start).order_by(start).all()
+
+def active_users_per_bucket(session, since: datetime.datetime, until: datetime.datetime,
+  bucket: str = "hour") -> List[Tuple[datetime.datetime, int]]:
+  """ Number of distinct users with any event per bucket. """
+  if bucket not in BUCKETS:
+    raise ValueError(f"bucket must be one of {BUCKETS}")
+  start = func.date_trunc(bucket, Event.created_on).label("start")
+  return session.query(start, func.count(Event.uid.distinct())) \
+    .filter(Event.created_on >= since, Event.created_on < until) \
+    .group_by(start).order_by(start).all()
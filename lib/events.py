@@ -10,3 +10,5 @@ SIMULATION_FILE_SERVER_STOPPED = "SIMULATION_FILE_SERVER_STOPPED"
 CONTAINER_UPGRADE = "CONTAINER_UPGRADE"
 
 CONTAINER_DESTROYED = "CONTAINER_DESTROYED"
+
+QUEUED = "QUEUED"
@@ -0,0 +1,47 @@
+""" The id of the current notebook image, cached in redis.
+
+Every container start compares the container's image with the current image, to tell the user that
+an update is available. The image only changes when it is rebuilt (see build.sh), so its id is cached
+until the monitor sees an image event for it.
+"""
+
+from typing import Optional
+
+from lib.docker_client import DockerError, get_client as docker
+
+IMAGE_NAME = "nb-simple"
+KEY = f"images.{IMAGE_NAME}"
+
+# Image events that can change which image `IMAGE_NAME` refers to.
+ACTIONS = {"tag", "untag", "pull", "load", "import", "delete"}
+
+
+def _decode(value):
+  return value.decode("utf-8") if isinstance(value, bytes) else value
+
+def current_id(r) -> Optional[str]:
+  """ Id of the image that new containers are created from, None if there is no such image. """
+  image_id = r.get(KEY)
+  if image_id is not None:
+    return _decode(image_id)
+
+  try:
+    image = docker().inspect_image(IMAGE_NAME)
+  except DockerError as e:
+    print("error getting image info", e)
+    return None
+  if image is None:
+    return None
+  r.set(KEY, image["Id"])
+  return image["Id"]
+
+def invalidate(r):
+  r.delete(KEY)
+
+def is_relevant_event(event) -> bool:
+  """ Whether a docker image event may have changed the current image. """
+  if event.get("Action") not in ACTIONS:
+    return False
+  name = event.get("Actor", {}).get("Attributes", {}).get("name", "")
+  # untag and delete events only carry the image id, so they always invalidate
+  return name == "" or name.split(":")[0] == IMAGE_NAME
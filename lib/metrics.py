@@ -0,0 +1,237 @@
+""" Metrics in the Prometheus text format.
+
+Every process has a registry of counters, gauges and histograms, which are served at `/metrics`: by
+the web server as a route, by the worker and the monitor with `serve`. Updating a metric is a dict
+lookup and an addition under a lock, so metrics can stay on in production. `render` returns the text
+that Prometheus would scrape, which is what tests can check.
+
+Metrics of short lived processes (rq jobs in forked workers) are kept in redis with `RedisHistogram`,
+and read by the long lived process that serves them.
+"""
+
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a cached asset to a container start
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+  pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+  type = None
+
+  def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+    self.name = name
+    self.documentation = documentation
+    self.label_names = tuple(labels)
+    self._lock = threading.Lock()
+
+  def _key(self, labels: Dict[str, object]) -> Tuple:
+    return tuple(str(labels[name]) for name in self.label_names)
+
+  def samples(self) -> Iterable[Tuple[str, str, float]]:
+    """ (name suffix, formatted labels, value) of each sample. """
+    raise NotImplementedError
+
+  def render(self) -> str:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+    for suffix, labels, value in self.samples():
+      lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+  type = "counter"
+
+  def __init__(self, name, documentation, labels=()):
+    super().__init__(name, documentation, labels)
+    self._values = {} if self.label_names else {(): 0}
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def samples(self):
+    with self._lock:
+      values = list(self._values.items())
+    for key, value in values:
+      yield "_total", _format_labels(self.label_names, key), value
+
+
+class Gauge(Metric):
+  type = "gauge"
+
+  def __init__(self, name, documentation, labels=(), function: Optional[Callable] = None):
+    """ With `function`, the value is computed when the metric is rendered. It returns a number, or
+    a dict of label values tuple -> number if the gauge has labels. """
+    super().__init__(name, documentation, labels)
+    self.function = function
+    self._values = {} if self.label_names else {(): 0}
+
+  def set(self, value: float, **labels):
+    with self._lock:
+      self._values[self._key(labels)] = value
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def dec(self, amount: float = 1, **labels):
+    self.inc(-amount, **labels)
+
+  def samples(self):
+    if self.function is not None:
+      value = self.function()
+      values = value.items() if self.label_names else [((), value)]
+    else:
+      with self._lock:
+        values = list(self._values.items())
+    for key, value in values:
+      yield "", _format_labels(self.label_names, key), value
+
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, name, documentation, labels=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+    super().__init__(name, documentation, labels)
+    self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+    self._values = {} # label values -> [bucket counts..., sum]
+
+  def observe(self, value: float, **labels):
+    key = self._key(labels)
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      counts = self._values.get(key)
+      if counts is None:
+        counts = self._values[key] = [0] * (len(self.buckets) + 1)
+      counts[i] += 1
+      counts[-1] += value
+
+  def _histogram_samples(self, values: List[Tuple[Tuple, List[float]]]):
+    for key, counts in values:
+      cumulative = 0
+      for bound, count in zip(self.buckets, counts):
+        cumulative += count
+        le = f'le="{_format_value(bound)}"'
+        yield "_bucket", _format_labels(self.label_names, key, le), cumulative
+      yield "_sum", _format_labels(self.label_names, key), counts[-1]
+      yield "_count", _format_labels(self.label_names, key), cumulative
+
+  def samples(self):
+    with self._lock:
+      values = [(key, list(counts)) for key, counts in self._values.items()]
+    return self._histogram_samples(values)
+
+
+class RedisHistogram(Histogram):
+  """ A histogram that is kept in a redis hash, so that it can be updated by many processes. """
+
+  def __init__(self, r, key: str, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    super().__init__(name, documentation, labels, buckets)
+    self.r = r
+    self.key = key
+
+  def observe(self, value: float, **labels):
+    label_key = "\t".join(self._key(labels))
+    i = bisect.bisect_left(self.buckets, value)
+    with self.r.pipeline(transaction=False) as pipe:
+      pipe.hincrby(self.key, f"{label_key}\n{i}", 1)
+      pipe.hincrbyfloat(self.key, f"{label_key}\nsum", value)
+      pipe.execute()
+
+  def samples(self):
+    values = {}
+    for field, value in self.r.hgetall(self.key).items():
+      field = field.decode("utf-8") if isinstance(field, bytes) else field
+      label_key, index = field.rsplit("\n", 1)
+      key = tuple(label_key.split("\t")) if self.label_names else ()
+      counts = values.setdefault(key, [0] * (len(self.buckets) + 1))
+      if index == "sum":
+        counts[-1] = float(value)
+      else:
+        counts[int(index)] = int(value)
+    return self._histogram_samples(list(values.items()))
+
+
+class Registry:
+  def __init__(self):
+    self._metrics = {}
+    self._lock = threading.Lock()
+
+  def register(self, metric: Metric) -> Metric:
+    with self._lock:
+      if metric.name in self._metrics:
+        raise ValueError(f"metric {metric.name} is already registered")
+      self._metrics[metric.name] = metric
+    return metric
+
+  def render(self) -> str:
+    with self._lock:
+      metrics = list(self._metrics.values())
+    parts = []
+    for metric in metrics:
+      try:
+        parts.append(metric.render())
+      except Exception as e: # e.g. redis is down, the other metrics are still useful
+        print("error rendering metric", metric.name, e)
+    return "".join(parts)
+
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labels=(), registry: Registry = REGISTRY) -> Counter:
+  return registry.register(Counter(name, documentation, labels))
+
+def gauge(name, documentation, labels=(), function=None, registry: Registry = REGISTRY) -> Gauge:
+  return registry.register(Gauge(name, documentation, labels, function=function))
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS,
+  registry: Registry = REGISTRY) -> Histogram:
+  return registry.register(Histogram(name, documentation, labels, buckets=buckets))
+
+def render(registry: Registry = REGISTRY) -> str:
+  return registry.render()
+
+
+def serve(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+  """ Serve `/metrics` on a thread, for processes without a web server. """
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split("?")[0] != "/metrics":
+        self.send_error(404)
+        return
+      body = registry.render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", CONTENT_TYPE)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass # scrapes are not worth a log line
+
+  server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
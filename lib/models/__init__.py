@@ -1,4 +1,4 @@
 from .activation_code import ActivationCode
 from .event import Event
-from .platform import File, Project
+from .platform import File, FileSummary, Project
 from .user import User
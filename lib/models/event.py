@@ -1,12 +1,21 @@
-from sqlalchemy import Column, String, ForeignKey
+from sqlalchemy import Column, DateTime, Index, String, ForeignKey
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
 
 from lib.models.base import Base
 
 
 class Event(Base):
   __tablename__ = "events"
+  __table_args__ = (
+    Index("ix_events_uid_created_on", "uid", "created_on"), # timelines
+    Index("ix_events_code_created_on", "code", "created_on"), # counts per event
+    {"postgresql_partition_by": "RANGE (created_on)"}, # see lib/event_store.py
+  )
+
+  # The partition key has to be part of the primary key.
+  created_on = Column(DateTime, primary_key=True, default=func.now())
 
   code = Column(String(255), nullable=False, unique=False)
   uid = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
@@ -1,12 +1,15 @@
-from sqlalchemy import Column, ForeignKey, String
+from sqlalchemy import BigInteger, Column, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 
 from lib.models.base import Base
 
 
 class Project(Base):
   __tablename__ = "projects"
+  __table_args__ = (
+    Index("ix_projects_owner_id_created_on_id", "owner_id", "created_on", "id"), # for listing
+  )
 
   name = Column(String(100), nullable=False)
 
@@ -27,9 +30,14 @@ class Project(Base):
 
 class File(Base):
   __tablename__ = "files"
+  __table_args__ = (
+    Index("ix_files_project_id_created_on_id", "project_id", "created_on", "id"), # for listing
+  )
 
   name = Column(String(100), nullable=False)
   path = Column(String(500), nullable=False)
+  content_hash = Column(String(64), nullable=True, index=True) # sha256, see lib/blob_store.py
+  size = Column(BigInteger, nullable=True)
 
   project_id = Column(UUID(as_uuid=True), ForeignKey("projects.id"), nullable=False)
   project = relationship("Project", backref="files", lazy="select")
@@ -42,4 +50,22 @@ class File(Base):
       **super().serialize(),
       "name": self.name,
       "project_id": self.project_id,
+      "content_hash": self.content_hash,
+      "size": self.size,
+    }
+
+
+class FileSummary(Base):
+  """ What is in a deck or resource file, by content hash, see lib/deck_files.py. """
+  __tablename__ = "file_summaries"
+
+  content_hash = Column(String(64), nullable=False, unique=True, index=True)
+  status = Column(String(20), nullable=False)
+  summary = Column(JSONB, nullable=True)
+  parser_version = Column(Integer, nullable=False)
+
+  def serialize(self):
+    return {
+      "status": self.status,
+      "summary": self.summary,
     }
@@ -0,0 +1,114 @@
+""" Password hashing on a bounded process pool.
+
+bcrypt is slow on purpose, and a burst of logins (everyone at a workshop logging in at once) would
+otherwise keep the web server's request threads busy and stall the notebook proxy. Hashes are
+computed by `PASSWORD_WORKERS` processes, and when `PASSWORD_MAX_PENDING` hashes are already queued,
+new ones are rejected right away with `PoolBusy` instead of waiting.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+from typing import Optional
+
+import bcrypt
+
+from lib.conf import PASSWORD_MAX_PENDING, PASSWORD_ROUNDS, PASSWORD_WORKERS
+
+TIMEOUT = 30 # seconds
+
+# The pool is started by the web server's worker process, which gevent has patched. Forked workers
+# would inherit the patched modules and the hub (and the executor's threads misbehave in them),
+# spawned workers start from a clean interpreter. Waiting for a result only blocks the greenlet.
+_context = multiprocessing.get_context("spawn")
+
+
+class PoolBusy(Exception):
+  """ The pool can't take the job now: too many are pending, it timed out, or a worker died. """
+
+
+def _hash(password: str, rounds: int) -> str:
+  return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+def _check(password_hash: str, password: str) -> bool:
+  try:
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+  except ValueError: # malformed hash
+    return False
+
+def get_rounds(password_hash: str) -> Optional[int]:
+  """ Work factor of a hash ("$2b$12$..." -> 12). """
+  try:
+    return int(password_hash.split("$")[2])
+  except (IndexError, ValueError):
+    return None
+
+
+class PasswordPool:
+  def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING,
+    rounds: int = PASSWORD_ROUNDS):
+    self.workers = workers
+    self.max_pending = max_pending
+    self.rounds = rounds
+    self.pending = 0 # submitted jobs that are not done, including ones whose caller timed out
+    self._executor = None
+    self._lock = threading.Lock()
+
+  def _release(self, _future=None):
+    with self._lock:
+      self.pending -= 1
+
+  def _reset(self, executor):
+    """ Drop a broken executor (a worker process died), the next job starts a new one. """
+    with self._lock:
+      if self._executor is executor:
+        self._executor = None
+    executor.shutdown(wait=False)
+    print("password pool: worker process died, restarting the pool")
+
+  def _submit(self, fn, *args):
+    with self._lock:
+      if self.pending >= self.max_pending:
+        raise PoolBusy()
+      self.pending += 1
+      if self._executor is None:
+        # created on first use, so that the workers are started by the web server's worker process
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_context)
+      executor = self._executor
+
+    try:
+      future = executor.submit(fn, *args)
+    except (BrokenProcessPool, RuntimeError): # broken, or shut down by a concurrent `_reset`
+      self._release()
+      self._reset(executor)
+      raise PoolBusy()
+    # the job stays counted until it is done, even if the caller stops waiting for it
+    future.add_done_callback(self._release)
+
+    try:
+      return future.result(TIMEOUT)
+    except FutureTimeoutError:
+      future.cancel() # only if it hasn't started
+      raise PoolBusy()
+    except BrokenProcessPool:
+      self._reset(executor)
+      raise PoolBusy()
+
+  def hash(self, password: str) -> str:
+    return self._submit(_hash, password, self.rounds)
+
+  def check(self, password_hash: str, password: str) -> bool:
+    return self._submit(_check, password_hash, password)
+
+  def needs_rehash(self, password_hash: str) -> bool:
+    return get_rounds(password_hash) != self.rounds
+
+
+_pool = None
+
+def get_pool() -> PasswordPool:
+  global _pool
+  if _pool is None:
+    _pool = PasswordPool()
+  return _pool
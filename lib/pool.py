@@ -0,0 +1,213 @@
+""" Warm pool of pre-started notebook containers.
+
+Pool containers are created like user containers, but with their own pool volume, and are started
+ahead of time. When a user without a container starts a session, a ready pool container is renamed to
+`nb-{uid}` and handed over together with its volume, so the user does not wait for the container and
+the notebook server to boot. The pool is refilled in the background by rq jobs.
+
+Pool containers are created with `NB_POOL=1`, which keeps the notebook server from shutting down
+for inactivity (`shutdown_no_activity_timeout`, see nb-docker/jupyter_notebook_config.py) until the
+container is claimed and `CLAIMED_MARKER` is written into it. The user keeps the pool volume, which is
+recorded in the docker index (see `lib.get_volume_name_for_user`).
+"""
+
+import functools
+import io
+import json
+import tarfile
+import uuid
+
+from lib.conf import POOL_SIZE
+from lib.docker_client import DockerError, get_client as docker
+import lib.docker_index as docker_index
+from lib.events import CONTAINER_STARTED
+import lib
+import lib.cache as cache
+import lib.project_sync as project_sync
+import lib.scheduler as scheduler
+import worker
+
+READY = "pool.ready" # list of names of containers with a running notebook server
+STARTING = "pool.starting" # set of names of containers that are booting
+STATS = "pool.stats" # hash of hit/miss counters
+CREATING = "pool.creating" # number of containers reserved by fill jobs that are not STARTING yet
+CREATING_TTL = 300 # seconds, reservations of a fill job that died are dropped after this
+
+# Reserves the containers missing from the pool, so that concurrent fill jobs don't create the same
+# ones. Returns the number of reserved containers.
+_RESERVE = """
+local ready, starting, creating = KEYS[1], KEYS[2], KEYS[3]
+local size, ttl = tonumber(ARGV[1]), tonumber(ARGV[2])
+local pending = tonumber(redis.call('get', creating) or '0')
+if pending < 0 then -- released after the reservations expired
+  pending = 0
+  redis.call('set', creating, 0)
+end
+local missing = size - redis.call('llen', ready) - redis.call('scard', starting) - pending
+if missing <= 0 then return 0 end
+redis.call('incrby', creating, missing)
+redis.call('expire', creating, ttl)
+return missing
+"""
+
+PREFIX = "nb-pool-"
+ENV = ["NB_POOL=1"]
+CLAIMED_MARKER = "/tmp/nb-pool-claimed"
+
+
+def enabled():
+  return POOL_SIZE > 0
+
+def is_pool_container(name):
+  return name.startswith(PREFIX)
+
+def _decode(value):
+  return value.decode("utf-8") if isinstance(value, bytes) else value
+
+def get_volume_name(name):
+  return f"{name[len('nb-'):]}-volume"
+
+
+def fill():
+  """ Create and start pool containers until the pool is full. (rq job) """
+  with worker.get_redis() as r:
+    reserved = r.eval(_RESERVE, 3, READY, STARTING, CREATING, POOL_SIZE, CREATING_TTL)
+    try:
+      while reserved > 0:
+        name = f"{PREFIX}{uuid.uuid4().hex[:12]}"
+        volume_name = get_volume_name(name)
+        print("POOL: creating", name)
+        try:
+          docker().create_volume(volume_name)
+        except DockerError as e:
+          print("POOL: error creating volume", e)
+          return
+        docker_index.add_volume(volume_name)
+        err = lib.create_container(name, volume_name, env=ENV)
+        if err is not None:
+          return
+
+        with r.pipeline() as pipe: # the reservation becomes a starting container
+          pipe.sadd(STARTING, name)
+          pipe.decr(CREATING)
+          pipe.execute()
+        reserved -= 1
+        try:
+          docker().start_container(name)
+        except DockerError as e:
+          print("POOL: error starting container", e)
+          r.srem(STARTING, name)
+          destroy(name)
+          return
+    finally:
+      if reserved > 0: # give back what was not created
+        r.decrby(CREATING, reserved)
+
+def mark_ready(r, name):
+  """ Called by the readiness watcher when the notebook server in a pool container is ready. """
+  with r.pipeline() as pipe:
+    pipe.srem(STARTING, name)
+    pipe.rpush(READY, name)
+    pipe.execute()
+  print("POOL: ready", name)
+
+def destroy(name):
+  """ Remove a pool container and its volume. (rq job) """
+  volume_name = get_volume_name(name)
+  for remove, remove_from_index, arg in [
+    (docker().remove_container, docker_index.remove_container, name),
+    (docker().remove_volume, docker_index.remove_volume, volume_name)]:
+    try:
+      remove(arg)
+      remove_from_index(arg)
+    except DockerError as e:
+      print("POOL: error destroying", name, e)
+
+
+def handle_pool_container_started(r, name, readiness):
+  print("HANDLER: handle_pool_container_started", name)
+  # If the notebook server doesn't come up, stopping the container makes the monitor replace it.
+  readiness.watch(name, functools.partial(mark_ready, r, name),
+    on_timeout=functools.partial(docker().stop_container, name))
+
+def handle_pool_container_stopped(r, name, q):
+  print("HANDLER: handle_pool_container_stopped", name)
+  with r.pipeline() as pipe:
+    pipe.lrem(READY, 0, name)
+    pipe.srem(STARTING, name)
+    pipe.execute()
+  q.enqueue_call(destroy, args=(name,))
+  q.enqueue_call(fill)
+
+
+def claim(r, uid, q) -> bool:
+  """ Hand a ready pool container to a user that doesn't have a container or volume yet. Returns
+  whether a container was claimed. """
+
+  if not enabled():
+    return False
+  if lib.container_exists(lib.get_host_for_user(uid)) or lib.volume_exists_for_user(uid):
+    return False
+
+  name = _decode(r.lpop(READY))
+  if name is None:
+    r.hincrby(STATS, "misses", 1)
+    q.enqueue_call(fill)
+    return False
+
+  try:
+    docker().rename_container(name, lib.get_host_for_user(uid))
+  except DockerError as e:
+    print("POOL: error claiming", name, e)
+    q.enqueue_call(destroy, args=(name,))
+    q.enqueue_call(fill)
+    return False
+  docker_index.rename_container(name, lib.get_host_for_user(uid))
+  docker_index.set_user_volume(uid, get_volume_name(name))
+  try:
+    _write_claimed_marker(lib.get_host_for_user(uid))
+  except DockerError as e:
+    # the container keeps running until it is stopped, the user still gets it
+    print("POOL: error marking", name, "claimed", e)
+
+  r.hincrby(STATS, "hits", 1)
+  print("POOL: claimed", name, "for", uid)
+
+  # The container is already running, so the monitor will not see a start event for the user.
+  cache.set(r, cache.keys.container_running, 1, uid)
+  scheduler.mark_running(r, uid)
+  r.publish(lib.get_pubsub_channel_name(uid), json.dumps({"event": CONTAINER_STARTED}))
+  lib.save_event(r, uid, CONTAINER_STARTED)
+  lib.handle_notebook_started(r, uid)
+  q.enqueue_call(project_sync.sync, args=(str(uid),)) # projects uploaded before the first session
+
+  q.enqueue_call(fill)
+  return True
+
+
+def _write_claimed_marker(name):
+  """ Let the notebook server in a claimed container shut down when it is idle, like any other. """
+  archive = io.BytesIO()
+  with tarfile.open(fileobj=archive, mode="w") as tar:
+    tar.addfile(tarfile.TarInfo(CLAIMED_MARKER.rsplit("/", 1)[1]))
+  size = archive.tell()
+  docker().put_archive(name, CLAIMED_MARKER.rsplit("/", 1)[0], archive, size)
+
+
+def stats(r) -> dict:
+  """ Pool size and hit rate, for sizing the pool. """
+  with r.pipeline() as pipe:
+    pipe.llen(READY)
+    pipe.scard(STARTING)
+    pipe.hgetall(STATS)
+    ready, starting, counters = pipe.execute()
+  counters = {_decode(k): int(v) for k, v in counters.items()}
+  hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+  return {
+    "pool_size": POOL_SIZE,
+    "ready": ready,
+    "starting": starting,
+    "hits": hits,
+    "misses": misses,
+    "hit_rate": hits / (hits + misses) if hits + misses > 0 else None,
+  }
@@ -0,0 +1,106 @@
+""" Mirror the files of a user's platform projects into their notebook volume.
+
+Project files are written to `projects/<project>/` in the notebook directory. Which content was
+synced is kept per volume in redis (`sync.<volume>`: path in the volume -> content hash), so a sync
+only sends the files whose hash changed, all of them in one tar archive that docker extracts into the
+container. Syncs are rq jobs on the background queue: after an upload, and when a container starts,
+so they never hold up a session. Claimed pool containers are synced by `lib.pool.claim`, they don't
+have a start event under the user's name.
+
+Files are not removed from the volume, users may have edited them in the notebook.
+"""
+
+import os
+import re
+import tarfile
+import tempfile
+import time
+from typing import Iterable, Optional
+
+import lib
+from lib.docker_client import get_client as docker
+from lib.models import File, Project
+import worker
+
+PROJECTS_DIR = "projects"
+SPOOL_SIZE = 8 * 1024 * 1024 # archives larger than this are written to a temporary file
+
+# owner of the notebook files in the container, jovyan:users in jupyter's images
+NB_UID = 1000
+NB_GID = 100
+
+
+def _safe_name(name: str) -> str:
+  return re.sub(r"[^A-Za-z0-9_.-]", "_", name).strip("._")
+
+def _state_key(volume_name: str) -> str:
+  return f"sync.{volume_name}"
+
+def project_dir(project) -> str:
+  """ Directory of a project in the notebook volume, unique even if names are not. """
+  return f"{_safe_name(project.name) or 'project'}-{str(project.id)[:8]}"
+
+def file_name(f) -> str:
+  """ Name of a file in the volume. Names that are empty once made safe are named by content. """
+  return _safe_name(f.name) or f"file-{f.content_hash[:12]}"
+
+def _tar_info(name: str, size: int = 0, directory: bool = False) -> tarfile.TarInfo:
+  info = tarfile.TarInfo(name)
+  info.uid, info.gid, info.uname, info.gname = NB_UID, NB_GID, "jovyan", "users"
+  info.mtime = int(time.time())
+  if directory:
+    info.type, info.mode = tarfile.DIRTYPE, 0o755
+  else:
+    info.size, info.mode = size, 0o644
+  return info
+
+
+def sync(uid, project_ids: Optional[Iterable] = None) -> int:
+  """ Send the changed files of the user's projects (or of `project_ids`) to their container.
+  Returns the number of files sent. (rq job) """
+  container_name = lib.get_host_for_user(uid)
+  if not lib.container_exists(container_name):
+    return 0 # synced when the container starts
+  volume_name = lib.get_volume_for_container(container_name)
+  if volume_name is None:
+    return 0
+
+  with worker.get_db_session() as session, worker.get_redis() as r:
+    query = session.query(Project).filter(Project.owner_id == uid)
+    if project_ids is not None:
+      query = query.filter(Project.id.in_(list(project_ids)))
+    projects = {project.id: project for project in query.all()}
+    if len(projects) == 0:
+      return 0
+    files = session.query(File) \
+      .filter(File.project_id.in_(list(projects)), File.content_hash.isnot(None)) \
+      .order_by(File.created_on).all() # the newest file wins if names repeat
+
+    synced = {k.decode("utf-8") if isinstance(k, bytes) else k:
+              v.decode("utf-8") if isinstance(v, bytes) else v
+              for k, v in r.hgetall(_state_key(volume_name)).items()}
+    # keyed by the path in the volume, names that are the same once made safe are one file
+    changed = {}
+    for f in files:
+      path = f"{PROJECTS_DIR}/{project_dir(projects[f.project_id])}/{file_name(f)}"
+      if synced.get(path) != f.content_hash:
+        changed[path] = f
+      else:
+        changed.pop(path, None)
+    if len(changed) == 0:
+      return 0
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as archive:
+      with tarfile.open(fileobj=archive, mode="w") as tar:
+        tar.addfile(_tar_info(PROJECTS_DIR, directory=True))
+        for project_id in {f.project_id for f in changed.values()}:
+          tar.addfile(_tar_info(f"{PROJECTS_DIR}/{project_dir(projects[project_id])}", directory=True))
+        for path, f in changed.items():
+          with open(f.path, "rb") as data:
+            tar.addfile(_tar_info(path, size=os.fstat(data.fileno()).st_size), data)
+      size = archive.tell()
+      docker().put_archive(container_name, lib.NOTEBOOK_DIR, archive, size)
+
+    r.hset(_state_key(volume_name), mapping={path: f.content_hash for path, f in changed.items()})
+    print("synced", len(changed), "files to", container_name)
+    return len(changed)
@@ -0,0 +1,20 @@
+""" rq queues.
+
+Jobs that a user is waiting for (starting or upgrading their container) go on the interactive queue,
+everything else (creating containers at signup, filling the warm pool) on the background queue.
+Interactive workers only take interactive jobs, background workers take interactive jobs first, see
+worker/worker.py.
+"""
+
+from rq import Queue
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+DEFAULT = "default" # jobs enqueued before the split, handled as background jobs
+
+
+def interactive(connection) -> Queue:
+  return Queue(INTERACTIVE, connection=connection)
+
+def background(connection) -> Queue:
+  return Queue(BACKGROUND, connection=connection)
@@ -0,0 +1,107 @@
+""" Detect when the notebook server in a starting container is ready.
+
+One `ReadinessWatcher` per process watches any number of starting containers on an asyncio loop in a
+background thread, by probing the notebook API with exponential backoff. Callbacks are run on a small
+thread pool so that slow handlers (redis, db) don't hold up the probes.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from lib.conf import PRINT, READINESS_TIMEOUT
+
+NOTEBOOK_PORT = 8888
+NOTEBOOK_API_PATH = "/notebook/api" # base_url is /notebook/, see nb-docker/jupyter_notebook_config.py
+
+
+async def probe(host: str, port: int = NOTEBOOK_PORT, path: str = NOTEBOOK_API_PATH,
+  timeout: float = 2) -> bool:
+  """ Returns whether the notebook API answers with 200. """
+  try:
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  except (OSError, asyncio.TimeoutError):
+    return False
+
+  try:
+    writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    status_line = await asyncio.wait_for(reader.readline(), timeout)
+  except (OSError, asyncio.TimeoutError):
+    return False
+  finally:
+    writer.close()
+
+  parts = status_line.split()
+  return len(parts) >= 2 and parts[1] == b"200"
+
+
+class ReadinessWatcher:
+  """ Watch starting containers until their notebook server is ready, or a timeout passes. """
+
+  def __init__(self, timeout: float = READINESS_TIMEOUT, initial_backoff: float = 0.05,
+    max_backoff: float = 1, callback_threads: int = 4):
+    self.timeout = timeout
+    self.initial_backoff = initial_backoff
+    self.max_backoff = max_backoff
+    self._executor = ThreadPoolExecutor(max_workers=callback_threads)
+    self._loop = asyncio.new_event_loop()
+    self._tasks: Dict[str, asyncio.Task] = {}
+
+  def start(self):
+    def run():
+      asyncio.set_event_loop(self._loop)
+      self._loop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    return self
+
+  def watch(self, host: str, on_ready: Callable[[], None],
+    on_timeout: Optional[Callable[[], None]] = None, timeout: Optional[float] = None):
+    """ Start watching a container (thread safe). Watching a container again replaces the previous
+    watch, e.g. when it is restarted while starting. """
+    timeout = timeout or self.timeout
+    self._loop.call_soon_threadsafe(self._watch, host, on_ready, on_timeout, timeout)
+
+  def cancel(self, host: str):
+    self._loop.call_soon_threadsafe(self._cancel, host)
+
+  def _cancel(self, host: str):
+    task = self._tasks.pop(host, None)
+    if task is not None:
+      task.cancel()
+
+  def _watch(self, host, on_ready, on_timeout, timeout):
+    self._cancel(host)
+    self._tasks[host] = self._loop.create_task(self._run(host, on_ready, on_timeout, timeout))
+
+  async def _run(self, host, on_ready, on_timeout, timeout):
+    start = time.monotonic()
+    deadline = start + timeout
+    backoff = self.initial_backoff
+    try:
+      while time.monotonic() < deadline:
+        if await probe(host):
+          if PRINT: print(f"notebook ready: {host} ({time.monotonic() - start:.2f}s)")
+          self._loop.run_in_executor(self._executor, self._call, on_ready)
+          return
+        await asyncio.sleep(min(backoff, max(0, deadline - time.monotonic())))
+        backoff = min(backoff * 2, self.max_backoff)
+
+      print(f"notebook not ready after {timeout}s: {host}")
+      if on_timeout is not None:
+        self._loop.run_in_executor(self._executor, self._call, on_timeout)
+    finally:
+      if self._tasks.get(host) is asyncio.current_task():
+        self._tasks.pop(host)
+
+  @staticmethod
+  def _call(callback):
+    try:
+      callback()
+    except Exception as e:
+      print("error in readiness callback", e)
+
+  def watching(self) -> int:
+    return len(self._tasks)
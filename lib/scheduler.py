@@ -0,0 +1,135 @@
+""" Admission control for starting notebook containers.
+
+At most `MAX_RUNNING_CONTAINERS` user containers run at the same time (0 for no limit). Starts over
+the limit wait in a FIFO queue, and the queued users get their position over their pubsub channel.
+When a container stops, the monitor releases its slot and the next users in the queue are started.
+Users that close their last /master websocket while queued leave the queue.
+A start that fails releases its slot right away (see `lib.run_pod`), there is no stop event for it.
+
+Two starts don't go through admission: claiming a warm pool container (lib.pool) hands over a
+container that is already running on the host, and an upgrade (`lib.update_container`) restarts the
+user's container in its own slot. Both are counted with `mark_running`. During an upgrade, the slot
+is released by the stop event before the new container starts, so the limit can be exceeded by the
+number of upgrades in progress.
+
+State is kept in redis and updated with lua scripts, so that all web processes and the monitor agree.
+"""
+
+import json
+from typing import List
+
+from lib.conf import MAX_RUNNING_CONTAINERS
+from lib.events import QUEUED
+
+RUNNING = "scheduler.running" # set of uids that were admitted or are running
+QUEUE = "scheduler.queue" # list of uids waiting to start
+CONNECTIONS = "scheduler.connections" # hash of uid -> open /master websockets
+
+# Counts a closed websocket, and takes the user out of the queue when it was their last one. Returns
+# whether the user was queued.
+_DISCONNECT = """
+local connections, queue = KEYS[1], KEYS[2]
+local uid = ARGV[1]
+if redis.call('hincrby', connections, uid, -1) > 0 then return 0 end
+redis.call('hdel', connections, uid)
+return redis.call('lrem', queue, 0, uid)
+"""
+
+# Returns 0 if the user may start now, or their position in the queue.
+_REQUEST_START = """
+local running, queue = KEYS[1], KEYS[2]
+local uid, limit = ARGV[1], tonumber(ARGV[2])
+if redis.call('sismember', running, uid) == 1 then return 0 end
+local pos = redis.call('lpos', queue, uid)
+if pos then return pos + 1 end
+if redis.call('scard', running) < limit and redis.call('llen', queue) == 0 then
+  redis.call('sadd', running, uid)
+  return 0
+end
+return redis.call('rpush', queue, uid)
+"""
+
+# Releases a slot, returns the uids that are admitted from the queue.
+_RELEASE = """
+local running, queue = KEYS[1], KEYS[2]
+local uid, limit = ARGV[1], tonumber(ARGV[2])
+redis.call('srem', running, uid)
+local admitted = {}
+while redis.call('scard', running) < limit do
+  local next = redis.call('lpop', queue)
+  if not next then break end
+  redis.call('sadd', running, next)
+  table.insert(admitted, next)
+end
+return admitted
+"""
+
+
+def enabled():
+  return MAX_RUNNING_CONTAINERS > 0
+
+def _decode(value):
+  return value.decode("utf-8") if isinstance(value, bytes) else value
+
+def _channel(uid):
+  return f"user-{uid}" # see lib.get_pubsub_channel_name
+
+
+def request_start(r, uid) -> int:
+  """ Returns 0 if the user's container may be started now, or the user's position in the queue. """
+  if not enabled():
+    return 0
+  position = r.eval(_REQUEST_START, 2, RUNNING, QUEUE, str(uid), MAX_RUNNING_CONTAINERS)
+  if position > 0:
+    print("SCHEDULER: queued", uid, "at", position)
+  return position
+
+def mark_running(r, uid):
+  """ Count a container that was started without `request_start`, e.g. an upgrade. """
+  if enabled():
+    r.sadd(RUNNING, str(uid))
+
+def release(r, uid=None) -> List[str]:
+  """ Release the slot of a stopped container, or without `uid` only admit users if there is room.
+  Returns the uids of the users that can start now. The users still in the queue are sent their new
+  position. """
+  if not enabled():
+    return []
+  uid = "" if uid is None else str(uid)
+  admitted = [_decode(u) for u in r.eval(_RELEASE, 2, RUNNING, QUEUE, uid, MAX_RUNNING_CONTAINERS)]
+  if len(admitted) > 0:
+    print("SCHEDULER: admitted", admitted)
+    publish_positions(r, admitted=admitted)
+  return admitted
+
+def connect(r, uid):
+  """ Count an open /master websocket of the user, see `disconnect`. """
+  if enabled():
+    r.hincrby(CONNECTIONS, str(uid), 1)
+
+def disconnect(r, uid):
+  """ Called when a /master websocket closes. A user that left while queued is taken out of the
+  queue, otherwise they would be started when admitted and hold a slot until the idle shutdown. """
+  if not enabled():
+    return
+  if r.eval(_DISCONNECT, 2, CONNECTIONS, QUEUE, str(uid)) > 0:
+    print("SCHEDULER: left the queue", uid)
+    publish_positions(r)
+
+def publish_positions(r, admitted=()):
+  with r.pipeline(transaction=False) as pipe:
+    for uid in admitted:
+      pipe.publish(_channel(uid), json.dumps({"event": QUEUED, "position": 0}))
+    for i, uid in enumerate(r.lrange(QUEUE, 0, -1)):
+      pipe.publish(_channel(_decode(uid)), json.dumps({"event": QUEUED, "position": i + 1}))
+    pipe.execute()
+
+def sync(r, running_uids):
+  """ Reset the running set to the containers that are actually running. """
+  if not enabled():
+    return
+  with r.pipeline() as pipe:
+    pipe.delete(RUNNING)
+    if len(running_uids) > 0:
+      pipe.sadd(RUNNING, *running_uids)
+    pipe.execute()
@@ -0,0 +1,79 @@
+""" Rolling upgrade of running notebook containers to the current image.
+
+Only idle containers are upgraded: the notebook server has no open connections and no activity for
+a while, so nobody loses their session. Busy users keep the "update available" button, and stopped
+containers are upgraded when they start again (see `lib.run_pod`).
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import json
+from typing import Callable, Dict, List, Optional
+import urllib.request
+
+import lib
+from lib.docker_client import get_client as docker
+import lib.images as images
+import lib.pool as pool
+
+UPGRADED = "upgraded"
+BUSY = "busy"
+FAILED = "failed"
+
+
+def outdated_uids(r) -> List[str]:
+  """ Users whose running container is not on the current image. """
+  current_image = images.current_id(r)
+  if current_image is None:
+    raise Exception("error getting image info")
+
+  uids = []
+  for name in docker().list_containers(all=False):
+    if not name.startswith("nb-") or pool.is_pool_container(name):
+      continue
+    container = docker().inspect_container(name)
+    if container is not None and container["Image"] != current_image:
+      uids.append(name[len("nb-"):])
+  return uids
+
+def notebook_status(uid, timeout: float = 2) -> Optional[dict]:
+  """ Status of the user's notebook server (connections and last activity), None if unreachable. """
+  url = f"http://{lib.get_host_for_user(uid)}:8888/notebook/api/status"
+  try:
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+      return json.loads(resp.read())
+  except Exception as e:
+    print("error getting notebook status", uid, e)
+    return None
+
+def is_idle(status: Optional[dict], idle_seconds: float) -> bool:
+  if status is None or status.get("connections", 0) > 0:
+    return False
+  last_activity = datetime.datetime.fromisoformat(status["last_activity"].replace("Z", "+00:00"))
+  idle_for = datetime.datetime.now(datetime.timezone.utc) - last_activity
+  return idle_for.total_seconds() >= idle_seconds
+
+def upgrade_if_idle(uid, idle_seconds: float) -> str:
+  if not is_idle(notebook_status(uid), idle_seconds):
+    return BUSY
+  try:
+    lib.update_container(uid)
+  except Exception as e:
+    print("error upgrading container", uid, e)
+    return FAILED
+  return UPGRADED
+
+def rolling_upgrade(r, concurrency: int = 4, idle_seconds: float = 120,
+  progress: Callable[[int, int, str, str], None] = None) -> Dict[str, int]:
+  """ Upgrade the idle outdated containers, `concurrency` at a time. `progress` is called with
+  (done, total, uid, result) after each container. Returns the number of containers per result. """
+  uids = outdated_uids(r)
+  counts = {UPGRADED: 0, BUSY: 0, FAILED: 0}
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    futures = {executor.submit(upgrade_if_idle, uid, idle_seconds): uid for uid in uids}
+    for done, future in enumerate(as_completed(futures), start=1):
+      result = future.result()
+      counts[result] += 1
+      if progress is not None:
+        progress(done, len(uids), futures[future], result)
+  return counts
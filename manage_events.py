@@ -0,0 +1,62 @@
+import argparse
+import datetime
+import sys
+
+from lib.db import engine, get_session
+import lib.event_store as event_store
+from lib.events import CONTAINER_STARTED
+from lib.models import User
+
+
+def parse_time(value):
+  return datetime.datetime.fromisoformat(value)
+
+def get_uid(session, user):
+  """ Users can be given by id or email. """
+  if "@" in user:
+    u = session.query(User).filter_by(email=user).first()
+    if u is None:
+      print("Error: no user with email", user)
+      sys.exit(1)
+    return u.id
+  return user
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Query and maintain the events table")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  now = datetime.datetime.utcnow()
+  day_ago = now - datetime.timedelta(days=1)
+
+  timeline = commands.add_parser("timeline", help="events of a user, newest first")
+  timeline.add_argument("user", help="user id or email")
+  timeline.add_argument("--limit", type=int, default=100)
+
+  for name, help_ in [("count", "number of events with a code per bucket"),
+                      ("active-users", "number of users with any event per bucket")]:
+    command = commands.add_parser(name, help=help_)
+    command.add_argument("--since", type=parse_time, default=day_ago, help="UTC, default a day ago")
+    command.add_argument("--until", type=parse_time, default=now, help="UTC, default now")
+    command.add_argument("--bucket", choices=event_store.BUCKETS, default="hour")
+    if name == "count":
+      command.add_argument("--code", default=CONTAINER_STARTED)
+
+  commands.add_parser("partition", help="partition an existing unpartitioned events table")
+
+  args = parser.parse_args()
+  session = get_session()
+
+  if args.command == "timeline":
+    for event in event_store.timeline(session, get_uid(session, args.user)).limit(args.limit):
+      print(event.created_on.isoformat(), event.code)
+  elif args.command == "count":
+    for start, count in event_store.count_per_bucket(session, args.code, args.since, args.until,
+      args.bucket):
+      print(start.isoformat(), count)
+  elif args.command == "active-users":
+    for start, count in event_store.active_users_per_bucket(session, args.since, args.until,
+      args.bucket):
+      print(start.isoformat(), count)
+  elif args.command == "partition":
+    print("copied", event_store.partition_existing_table(engine), "events")
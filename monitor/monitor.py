@@ -1,54 +1,209 @@
-""" Use `docker events` to monitor for container events, and update things accordingly."""
+""" Use `docker events` to monitor for container events, and update things accordingly.
 
-import json
+Events are read by a single consumer, which reconnects from the last seen event when the stream ends,
+and are handled by a number of shard threads. All events of a container are handled by the same
+shard, so they are handled in order, while events of different users are handled in parallel.
+"""
+
+import collections
 import os
+import queue
 import signal
-import subprocess
 import sys
+import threading
+import time
+import zlib
 
 import redis
-from rq import Queue
 
 sys.path.insert(0, ".")
 
 import lib
+from lib.conf import METRICS_PORT, MONITOR_SHARDS
+from lib.docker_client import get_client as docker
+import lib.docker_index as docker_index
+import lib.images as images
+from lib import metrics
+from lib.event_sink import EventFlusher
+from lib.event_store import maintain_partitions
+import lib.pool as pool
+import lib.project_sync as project_sync
+import lib.queues as queues
+from lib.readiness import ReadinessWatcher
+import lib.scheduler as scheduler
 
+FILTERS = {"type": ["container", "volume", "image"]}
+LAG_WARNING = 5 # seconds
+
+event_lag = metrics.gauge("monitor_event_lag_seconds",
+  "Seconds between a docker event happening and it being handled, for the last event")
+events_handled = metrics.counter("monitor_events", "Docker events handled", labels=("type", "action"))
+event_duration = metrics.histogram("monitor_event_duration_seconds", "Time to handle a docker event",
+  labels=("type",))
 
-def main():
-  redis_host = os.environ.get("REDIS_HOST", "localhost")
-  redis_client = redis.Redis(host=redis_host, port=6379, db=0)
-  q = Queue(connection=redis_client)
 
-  p = subprocess.Popen("docker events --format '{{json .}}' --filter 'type=container'",
-    shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def handle_event(redis_client, q, q_background, readiness, event):
+  print("M"*10, "event:", event)
 
-  session = lib.db.get_session()
+  if event.get("Type") == "image":
+    if images.is_relevant_event(event):
+      images.invalidate(redis_client)
 
-  while True:
-    line = p.stdout.readline()
-    if not line:
-      continue
+  if event.get("Type") == "volume":
+    name = event.get("Actor", {}).get("ID")
+    if event.get("Action") == "create":
+      docker_index.add_volume(name)
+    elif event.get("Action") == "destroy":
+      docker_index.remove_volume(name)
 
-    event = json.loads(line)
-    print("M"*10, "event:", event)
+  if event.get("Type") == "container":
+    attributes = event.get("Actor", {}).get("Attributes", {})
+    name = attributes.get("name")
+    if name is None:
+      return
 
-    if event.get("Type") == "container":
-      name = event.get("Actor", {}).get("Attributes", {}).get("name")
-      if name is None or not name.startswith("nb-"):
-        continue
-      uid = name[3:] # nb-user-uuid, remove nb-. can be prettier (what if format changes?)
+    if event.get("Action") == "create":
+      docker_index.add_container(name)
+    elif event.get("Action") == "destroy":
+      docker_index.remove_container(name)
+    elif event.get("Action") == "rename":
+      docker_index.rename_container(attributes.get("oldName", "").lstrip("/"), name)
 
+    if not name.startswith("nb-"):
+      return
+
+    if pool.is_pool_container(name):
       if event.get("Action") == "start":
-        print("M"*10, "container started:", uid)
-        lib.handle_container_started(redis_client, session, uid, q)
-      elif event.get("Action") == "stop" or event.get("Action") == "die":
-        print("M"*10, "container stopped:", uid)
-        lib.handle_container_stopped(redis_client, session, uid)
-      elif event.get("Action") == "destroy":
-        print("M"*10, "container destroyed:", uid)
-        lib.handle_container_destroyed(redis_client, session, uid)
+        pool.handle_pool_container_started(redis_client, name, readiness)
+      elif event.get("Action") == "die":
+        readiness.cancel(name)
+        pool.handle_pool_container_stopped(redis_client, name, q_background)
+      return
+
+    uid = name[3:] # nb-user-uuid, remove nb-. can be prettier (what if format changes?)
+
+    # `docker stop` emits both die and stop, and a container that exits by itself only emits die,
+    # so die is the one to handle.
+    if event.get("Action") == "start":
+      print("M"*10, "container started:", uid)
+      lib.handle_container_started(redis_client, uid, readiness)
+      q_background.enqueue_call(project_sync.sync, args=(uid,))
+    elif event.get("Action") == "die":
+      print("M"*10, "container stopped:", uid)
+      readiness.cancel(name)
+      lib.handle_container_stopped(redis_client, uid)
+      for admitted_uid in scheduler.release(redis_client, uid):
+        q.enqueue_call(lib.run_pod, args=(admitted_uid,))
+    elif event.get("Action") == "destroy":
+      print("M"*10, "container destroyed:", uid)
+      lib.handle_container_destroyed(redis_client, uid)
+
+
+def _event_key(event):
+  actor = event.get("Actor", {})
+  return actor.get("Attributes", {}).get("name") or actor.get("ID") or ""
+
+
+class EventConsumer:
+  """ Read docker events and hand them to shard threads, see module docstring. """
+
+  def __init__(self, handle, num_shards: int = MONITOR_SHARDS, queue_size: int = 1000):
+    self.handle = handle
+    self.shards = [queue.Queue(queue_size) for _ in range(num_shards)]
+    self.since = None # timeNano of the last event read
+    self.lag = 0.0 # seconds between an event happening and it being handled
+    self._recent = collections.deque(maxlen=1000) # events around `since` are sent again on reconnect
+    self._recent_set = set()
+
+  def start(self, since_ns: int):
+    self.since = since_ns
+    for shard in self.shards:
+      threading.Thread(target=self._work, args=(shard,), daemon=True).start()
+    return self
+
+  def _work(self, shard: queue.Queue):
+    while True:
+      event = shard.get()
+      self.lag = time.time() - event.get("timeNano", 0) / 1e9
+      event_lag.set(self.lag)
+      if self.lag > LAG_WARNING:
+        print("M"*10, f"event lag: {self.lag:.1f}s")
+      start = time.perf_counter()
+      try:
+        self.handle(event)
+      except Exception as e:
+        print("M"*10, "error handling event", event, e)
+      # exec and health actions carry details after a colon ("exec_start: bash")
+      events_handled.inc(type=event.get("Type"), action=str(event.get("Action")).split(":")[0])
+      event_duration.observe(time.perf_counter() - start, type=event.get("Type"))
+
+  def _since_arg(self):
+    return f"{self.since // 10**9}.{self.since % 10**9:09d}"
+
+  def _is_duplicate(self, event) -> bool:
+    key = (event.get("timeNano"), event.get("Action"), event.get("Actor", {}).get("ID"))
+    if key in self._recent_set:
+      return True
+    if len(self._recent) == self._recent.maxlen:
+      self._recent_set.discard(self._recent[0])
+    self._recent.append(key)
+    self._recent_set.add(key)
+    return False
+
+  def dispatch(self, event):
+    if self._is_duplicate(event):
+      return
+    self.since = max(self.since, event.get("timeNano", 0))
+    shard = zlib.crc32(_event_key(event).encode()) % len(self.shards)
+    self.shards[shard].put(event) # blocks when the shard is behind
+
+  def run(self):
+    """ Read events forever, reconnecting from the last seen event. """
+    backoff = 0.1
+    while True:
+      try:
+        for event in docker().events(FILTERS, since=self._since_arg()):
+          backoff = 0.1
+          self.dispatch(event)
+        print("M"*10, "event stream ended, reconnecting")
+      except Exception as e:
+        print("M"*10, "error reading events, reconnecting", e)
+      time.sleep(backoff)
+      backoff = min(backoff * 2, 5)
+
+
+def main(redis_client):
+  q, q_background = queues.interactive(redis_client), queues.background(redis_client)
+  readiness = ReadinessWatcher().start()
+
+  # Seed the index, and read events from before the sync so that no create/destroy is missed.
+  since_ns = time.time_ns()
+  lib.sync_docker_index()
+  images.invalidate(redis_client) # the image may have been rebuilt while the monitor was down
+  for admitted_uid in lib.sync_scheduler(redis_client):
+    q.enqueue_call(lib.run_pod, args=(admitted_uid,))
+
+  if pool.enabled():
+    q_background.enqueue_call(pool.fill)
+
+  consumer = EventConsumer(lambda event: handle_event(redis_client, q, q_background, readiness, event))
+  metrics.gauge("monitor_pending_events", "Events waiting for a shard thread",
+    function=lambda: sum(shard.qsize() for shard in consumer.shards))
+  metrics.gauge("monitor_readiness_watches", "Containers whose notebook server is being probed",
+    function=readiness.watching)
+  metrics.serve(METRICS_PORT)
+  consumer.start(since_ns).run()
 
 
 if __name__ == "__main__":
-  signal.signal(signal.SIGTERM, lambda: sys.exit(0))
-  main()
+  signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+  redis_host = os.environ.get("REDIS_HOST", "localhost")
+  redis_client = redis.Redis(host=redis_host, port=6379, db=0)
+
+  maintain_partitions(lib.db.engine) # the flusher needs a partition for the current month
+  event_flusher = EventFlusher(redis_client, lib.db.get_session()).start()
+  try:
+    main(redis_client)
+  finally:
+    event_flusher.stop() # write remaining events to the db
@@ -1,3 +1,5 @@
+import os
+
 c.NotebookApp.tornado_settings = {
   'headers': {
     'Content-Security-Policy': "frame-ancestors http://127.0.0.1:5001 127.0.0.1:8888 'self'"
@@ -33,6 +35,20 @@ c.MappingKernelManager.cull_connected = False
 #  later. 0 (the default) disables this automatic shutdown.
 c.NotebookApp.shutdown_no_activity_timeout = 5*60 #1 after kernel has shut down, we don't care about the server anymore
 
+# Pool containers (NB_POOL=1, see lib/pool.py) wait for a user, they only shut down when idle after
+# they were claimed, which is when the demo server writes the marker file.
+if os.environ.get("NB_POOL") == "1":
+  from notebook.notebookapp import NotebookApp
+
+  POOL_CLAIMED_MARKER = "/tmp/nb-pool-claimed"
+  _shutdown_no_activity = NotebookApp.shutdown_no_activity
+
+  def shutdown_no_activity(self):
+    if os.path.exists(POOL_CLAIMED_MARKER):
+      _shutdown_no_activity(self)
+
+  NotebookApp.shutdown_no_activity = shutdown_no_activity
+
 # Whether to consider culling kernels which are busy. Only effective if
 #  cull_idle_timeout > 0.
 c.MappingKernelManager.cull_busy = True
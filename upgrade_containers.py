@@ -0,0 +1,19 @@
+import argparse
+
+from lib.docker_index import get_redis
+from lib.upgrade import rolling_upgrade
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Upgrade idle notebook containers to the current image")
+  parser.add_argument("--concurrency", type=int, default=4, help="containers upgraded at a time")
+  parser.add_argument("--idle-minutes", type=float, default=2,
+    help="minutes without activity before a notebook is considered idle")
+  args = parser.parse_args()
+
+  def progress(done, total, uid, result):
+    print(f"[{done}/{total}] {uid}: {result}")
+
+  counts = rolling_upgrade(get_redis(), concurrency=args.concurrency,
+    idle_seconds=args.idle_minutes * 60, progress=progress)
+  print(", ".join(f"{result}: {count}" for result, count in counts.items()))
@@ -1,25 +1,45 @@
 import contextlib
+import multiprocessing
+import multiprocessing.connection
 import os
+import signal
 import sys
+import time
 
 import redis
-from rq import Worker, Queue, Connection
+from rq import Worker, SimpleWorker, Queue, Connection
 from sqlalchemy.orm import Session
 
 sys.path.insert(0, ".")
 
 from lib import db
+from lib.conf import BACKGROUND_WORKERS, INTERACTIVE_WORKERS, METRICS_PORT, WORKER_MODE
+from lib import metrics
+from lib.queues import BACKGROUND, DEFAULT, INTERACTIVE
 
-listen = ["default"]
+# Queues are checked in order, so background workers pick up interactive jobs first.
+listen = {
+  INTERACTIVE: [INTERACTIVE],
+  BACKGROUND: [INTERACTIVE, DEFAULT, BACKGROUND],
+}
 
 redis_host = os.environ.get("REDIS_HOST")
 
+_redis = None # per worker process, see `get_redis`
+
 
 @contextlib.contextmanager
 def get_redis() -> redis.Redis:
-  # Not optimal to create a new connection for each job, but it does not really seem possible to
-  # share a connection within the worker. https://github.com/rq/rq/issues/720
-  # Perhaps we can use SimpleWorker, which, as mentioned in the thread, uses a single process.
+  # "fork" workers run each job in a new process, so a connection can't be shared between jobs
+  # (https://github.com/rq/rq/issues/720). "simple" workers run jobs in the worker process, which
+  # keeps a connection pool for all its jobs.
+  global _redis
+  if WORKER_MODE == "simple":
+    if _redis is None:
+      _redis = redis.StrictRedis(host=redis_host, port=6379, db=0, decode_responses=False)
+    yield _redis
+    return
+
   r = redis.StrictRedis(host=redis_host, port=6379, db=0, decode_responses=False)
   try:
     yield r
@@ -29,9 +49,8 @@ def get_redis() -> redis.Redis:
 
 @contextlib.contextmanager
 def get_db_session() -> Session:
-  # Not optimal to create a new connection for each job, but it does not really seem possible to
-  # share a connection within the worker. https://github.com/rq/rq/issues/720
-  # Perhaps we can use SimpleWorker or scoped_session.
+  # Removing the session returns its connection to the engine's pool, which lives as long as the
+  # worker process in "simple" mode.
   s = db.get_session()
   try:
     yield s
@@ -39,9 +58,58 @@ def get_db_session() -> Session:
     s.remove()
 
 
-if __name__ == "__main__":
+def job_durations(r) -> metrics.RedisHistogram:
+  # Jobs run in many processes (forked ones in "fork" mode), so durations are kept in redis and
+  # served by the main process.
+  return metrics.RedisHistogram(r, "metrics.jobs", "rq_job_duration_seconds",
+    "Time to run an rq job", labels=("queue", "func", "status"))
+
+
+class TimedWorkerMixin:
+  def perform_job(self, job, queue):
+    start = time.perf_counter()
+    success = super().perform_job(job, queue)
+    try:
+      job_durations(self.connection).observe(time.perf_counter() - start, queue=queue.name,
+        func=job.func_name, status="finished" if success else "failed")
+    except Exception as e:
+      print("error recording job duration", e)
+    return success
+
+class TimedWorker(TimedWorkerMixin, Worker): pass
+class TimedSimpleWorker(TimedWorkerMixin, SimpleWorker): pass
+
+
+def work(role: str):
   redis_client = redis.StrictRedis(host=redis_host, port=6379, db=0, decode_responses=False)
+  worker_class = TimedSimpleWorker if WORKER_MODE == "simple" else TimedWorker
 
   with Connection(redis_client):
-    worker = Worker(list(map(Queue, listen)))
+    worker = worker_class(list(map(Queue, listen[role])))
     worker.work()
+
+
+if __name__ == "__main__":
+  signal.signal(signal.SIGTERM, lambda *args: sys.exit(0)) # runs atexit, which stops the workers
+
+  processes = []
+  for role, count in [(INTERACTIVE, INTERACTIVE_WORKERS), (BACKGROUND, BACKGROUND_WORKERS)]:
+    for _ in range(count):
+      p = multiprocessing.Process(target=work, args=(role,), daemon=True)
+      p.start()
+      processes.append(p)
+  print(f"started {INTERACTIVE_WORKERS} interactive and {BACKGROUND_WORKERS} background workers",
+    f"({WORKER_MODE})")
+
+  redis_client = redis.StrictRedis(host=redis_host, port=6379, db=0, decode_responses=False)
+  metrics.gauge("rq_queue_depth", "Jobs waiting in a queue", labels=("queue",),
+    function=lambda: {(name,): len(Queue(name, connection=redis_client))
+                      for name in (INTERACTIVE, DEFAULT, BACKGROUND)})
+  metrics.REGISTRY.register(job_durations(redis_client))
+  metrics.serve(METRICS_PORT)
+
+  # Exit when a worker dies, so that the container is restarted.
+  multiprocessing.connection.wait([p.sentinel for p in processes])
+  for p in processes:
+    p.terminate()
+  sys.exit(1)